@@ -14,16 +14,35 @@ def create_parser():
 
     parser.add_argument(
         "command",
-        choices=["display", "server", "genportrait", "gengif"],
+        choices=["display", "server", "genportrait", "gengif", "rebuildmanifest", "ingest", "benchmark",
+                 "renderworker"],
         help="""
 display: Runs the interactive installation.
-         Switches:  camera_input, rotate, fullscreen, remote, host, port, stack_size, pool_size, image_dir.
-backend: Runs a processing backend that the display can connect to.
-         Switches:  stack_size, pool_size, image_dir.
+         Switches:  camera_input, rotate, fullscreen, remote, host, port, stack_size, pool_size, image_dir,
+                    image_format, compression, pipelined, render_fps, tracking, rpc_format, rpc_quality,
+                    preview_scale, metrics.
+server: Runs a processing backend that the display can connect to.
+        Switches:  host, port, stack_size, pool_size, image_dir, image_format, compression,
+                   server_threads, max_request_mb, debug_server, preview_scale, metrics,
+                   render_workers, accept_workers, worker_token, rpc_format, rpc_quality.
+renderworker: Aligns faces for a server on another host, so rendering is spread over several machines.
+              The server has to be started with --render_workers or --accept_workers.
+              Switches:  host, port, pool_size, server_threads, rpc_format, rpc_quality,
+                         register_with, advertise_host, worker_token.
 genportrait: Generates a merged portrait from all the images in the image dir.
-             Switches: image_dir, output_file, pool_size.
+             Only about pool_size images are held in memory, however many there are.
+             With a checkpoint_file, an interrupted run continues where it stopped.
+             Switches: image_dir, output_file, pool_size, checkpoint_file, checkpoint_interval, pin_targets.
 gengif: Generates a gif from the images in the image dir.
-        Switches: image_dir, output_file, pool_size, stack_size, loop.
+        Switches: image_dir, output_file, pool_size, stack_size, loop, intermediate_dir, frame_cache_mb.
+rebuildmanifest: Rebuilds the landmark manifest of the image dir from the json files.
+                 Switches: image_dir.
+ingest: Finds the faces in a directory of photos and adds them to the image dir.
+        Interrupted runs continue where they stopped.
+        Switches: input_dir, image_dir, pool_size, quality_filter, image_format, compression.
+benchmark: Times the portrait pipeline on synthetic faces and writes the results as json.
+           Switches: output_file, bench_resolutions, bench_stack_sizes, bench_pool_sizes, bench_repeat,
+                     bench_baseline.
         """
     )
 
@@ -46,6 +65,33 @@ gengif: Generates a gif from the images in the image dir.
         default=False,
         help="Whether to display the generated image fullscreen."
     )
+    parser.add_argument(
+        "--pipelined",
+        action='store_true',
+        default=False,
+        help="Whether to capture, detect faces and render on separate threads.\n" +
+             "Frames that arrive while a detection is running are dropped."
+    )
+    parser.add_argument(
+        "--render_fps",
+        default=20,
+        type=int,
+        help="How often the display is redrawn per second in pipelined mode."
+    )
+    parser.add_argument(
+        "--tracking",
+        action='store_true',
+        default=False,
+        help="Whether to only search for faces around their last position while they are tracked.\n" +
+             "The whole frame is searched when a face is lost and on an adaptive schedule."
+    )
+    parser.add_argument(
+        "--metrics",
+        action='store_true',
+        default=False,
+        help="Whether to record how long the pipeline stages take.\n" +
+             "The display shows them on the preview (toggle with m), the server on /metrics."
+    )
     parser.add_argument(
         "--remote",
         action='store_true',
@@ -57,13 +103,73 @@ gengif: Generates a gif from the images in the image dir.
     parser.add_argument(
         "--host",
         default="127.0.0.1",
-        help="The remote host IP adress."
+        help="The remote host IP adress, or the address the server listens on."
     )
     parser.add_argument(
         "--port",
         default=5000,
         type=int,
-        help="The remote port."
+        help="The remote port, or the port the server listens on."
+    )
+    parser.add_argument(
+        "--server_threads",
+        default=8,
+        type=int,
+        help="The number of threads the server handles requests on.\n" +
+             "Every display waiting for a new portrait keeps one thread busy."
+    )
+    parser.add_argument(
+        "--max_request_mb",
+        default=64,
+        type=int,
+        help="The largest request in megabytes the server accepts."
+    )
+    parser.add_argument(
+        "--debug_server",
+        action='store_true',
+        default=False,
+        help="Whether to run the server on the Flask debug server instead."
+    )
+    parser.add_argument(
+        "--render_workers",
+        default=None,
+        help="For the server, a comma separated list of render workers (host:port) to align faces on.\n" +
+             "Faces are split between the workers and the local pool by how quickly they get through them."
+    )
+    parser.add_argument(
+        "--accept_workers",
+        action='store_true',
+        default=False,
+        help="Whether the server lets render workers register themselves on /workers/register.\n" +
+             "Needs a --worker_token, only workers that know it can register."
+    )
+    parser.add_argument(
+        "--worker_token",
+        default=os.environ.get("FOTC_WORKER_TOKEN"),
+        help="A secret shared by the server and its render workers, the workers only align faces\n" +
+             "for requests with it.  Defaults to the FOTC_WORKER_TOKEN environment variable."
+    )
+    parser.add_argument(
+        "--register_with",
+        default=None,
+        help="For the render worker, the server (host:port) to register with."
+    )
+    parser.add_argument(
+        "--advertise_host",
+        default=None,
+        help="For the render worker, the address the server reaches it on.  Defaults to --host."
+    )
+    parser.add_argument(
+        "--rpc_format",
+        default="jpg",
+        choices=["jpg", "png"],
+        help="The image format to send frames to the remote backend in."
+    )
+    parser.add_argument(
+        "--rpc_quality",
+        default=95,
+        type=int,
+        help="The jpg quality (0 - 100) or png compression level (0 - 9) of the frames sent to the remote backend."
     )
     parser.add_argument(
         "--stack_size",
@@ -79,23 +185,111 @@ gengif: Generates a gif from the images in the image dir.
         type=int,
         help="The number of parallel processes to use."
     )
+    parser.add_argument(
+        "--preview_scale",
+        default=None,
+        type=float,
+        help="If given, a quick portrait is rendered at this scale (e.g. 0.25) and shown\n" +
+             "until the full resolution portrait is done."
+    )
     parser.add_argument(
         "--image_dir",
         default="images",
         help="The directory where the images taken in interactive mode should be saved.\n" +
              "It is also input directory for the image generation commands."
     )
+    parser.add_argument(
+        "--input_dir",
+        default=None,
+        help="The directory with the photos to ingest."
+    )
+    parser.add_argument(
+        "--quality_filter",
+        action='store_true',
+        default=False,
+        help="When ingesting, only keep the faces that would have triggered the camera at the display."
+    )
+    parser.add_argument(
+        "--image_format",
+        default="png",
+        choices=["png", "jpg", "webp"],
+        help="The format to save the images taken in interactive mode in."
+    )
+    parser.add_argument(
+        "--compression",
+        default=None,
+        type=int,
+        help="The compression level (png: 0 - 9) or quality (jpg, webp: 0 - 100) of the saved images.\n" +
+             "By default the OpenCV default is used."
+    )
     parser.add_argument(
         "--output_file",
         default=None,
         help="The path where to output the generated image or gif."
     )
+    parser.add_argument(
+        "--intermediate_dir",
+        default=None,
+        help="For the generated gif, a directory to also write the single frames to as png files.\n" +
+             "By default the frames are only streamed into ffmpeg."
+    )
+    parser.add_argument(
+        "--checkpoint_file",
+        default=None,
+        help="For the generated portrait, a file to save the progress to.\n" +
+             "If it exists, the merge continues from it."
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        default=60,
+        type=int,
+        help="For the generated portrait, how many seconds to wait between saving checkpoints."
+    )
+    parser.add_argument(
+        "--pin_targets",
+        action='store_true',
+        default=False,
+        help="For the generated portrait, whether to keep the target landmarks of the checkpoint,\n" +
+             "so images added since the last run are merged in instead of starting over."
+    )
     parser.add_argument(
         "--loop",
         action='store_true',
         default=False,
         help="For the generated gif, if it should loop."
     )
+    parser.add_argument(
+        "--frame_cache_mb",
+        default=1024,
+        type=int,
+        help="How many megabytes of decoded images to keep in memory while generating images."
+    )
+    parser.add_argument(
+        "--bench_resolutions",
+        default="640x480,1280x720,1920x1080",
+        help="The frame sizes to benchmark, as a comma separated list of WIDTHxHEIGHT."
+    )
+    parser.add_argument(
+        "--bench_stack_sizes",
+        default="5,10",
+        help="The stack sizes to benchmark, comma separated."
+    )
+    parser.add_argument(
+        "--bench_pool_sizes",
+        default="1,4",
+        help="The pool sizes to benchmark, comma separated."
+    )
+    parser.add_argument(
+        "--bench_repeat",
+        default=3,
+        type=int,
+        help="How often every benchmark is timed."
+    )
+    parser.add_argument(
+        "--bench_baseline",
+        default=None,
+        help="The json file of an earlier benchmark run to compare the results to."
+    )
     parser.add_argument(
         "--stable_points",
         default="[]",
@@ -110,14 +304,21 @@ def run_display(args):
     from artsci2019.display import InteractiveDisplay
     if args.remote:
         from artsci2019.displaybackend.rpc.client import RemoteBackend
-        processing_backend = RemoteBackend(args.host, args.port)
+        processing_backend = RemoteBackend(args.host, args.port, args.rpc_format, args.rpc_quality)
     else:
         from artsci2019.displaybackend.backend import Backend
-        processing_backend = Backend(args.stack_size, args.pool_size, args.stable_points, args.image_dir)
+        processing_backend = Backend(args.stack_size, args.pool_size, args.stable_points, args.image_dir,
+                                     args.image_format, args.compression, args.preview_scale)
     a = InteractiveDisplay(args.camera_input,
                            args.rotate,
                            args.fullscreen,
-                           processing_backend)
+                           processing_backend,
+                           args.pipelined,
+                           args.render_fps,
+                           args.tracking,
+                           args.metrics)
+    if not args.remote and args.preview_scale is not None:
+        processing_backend.add_listener(a.show_portrait)
     init_successful = a.init()
     if not init_successful:
         print("Error in init.")
@@ -127,20 +328,65 @@ def run_display(args):
 
 
 def run_backend(args):
-    from artsci2019.displaybackend.rpc.server import create_app
-    app = create_app(args.stack_size, args.pool_size, args.stable_points, args.image_dir)
-    app.run(debug=True)
+    from artsci2019.displaybackend.rpc.server import create_app, serve
+    from artsci2019.lib.metrics import enable_metrics
+    enable_metrics(args.metrics)
+    max_request_bytes = args.max_request_mb * 1024 * 1024
+    if args.accept_workers and not args.worker_token:
+        logger.error("Accepting render workers needs a --worker_token.")
+        return
+    render_workers = None
+    if args.render_workers or args.accept_workers:
+        from artsci2019.displaybackend.rpc.render_dispatch import RenderWorkerRegistry
+        render_workers = RenderWorkerRegistry([w for w in (args.render_workers or "").split(",") if w])
+    app = create_app(args.stack_size, args.pool_size, args.stable_points, args.image_dir,
+                     args.image_format, args.compression, max_request_bytes, args.preview_scale,
+                     render_workers, args.rpc_format, args.rpc_quality, args.worker_token)
+    try:
+        if args.debug_server:
+            app.run(args.host, args.port, debug=True, use_reloader=False)
+        else:
+            serve(app, args.host, args.port, args.server_threads, max_request_bytes)
+    finally:
+        app.extensions['backend'].close()
+
+
+def run_render_worker(args):
+    from artsci2019.displaybackend.rpc.server import serve
+    from artsci2019.displaybackend.rpc.render_worker import create_worker_app, Registration
+    if args.register_with and not args.worker_token:
+        logger.error("Registering with a server needs its --worker_token.")
+        return
+    app = create_worker_app(args.pool_size, args.rpc_format, args.rpc_quality, args.worker_token)
+    registration = None
+    if args.register_with:
+        worker_url = "http://{}:{}".format(args.advertise_host or args.host, args.port)
+        registration = Registration(args.register_with, worker_url, args.pool_size, args.worker_token)
+        registration.start()
+    try:
+        serve(app, args.host, args.port, args.server_threads)
+    finally:
+        if registration is not None:
+            registration.stop()
+        app.extensions['alignment_pool'].close()
+
+
+def init_frame_cache(args):
+    from artsci2019.lib.frame_cache import configure_frame_cache
+    configure_frame_cache(args.frame_cache_mb * 1024 * 1024, args.pool_size)
 
 
 def run_portrait(args):
     from artsci2019.imagegen import run_portrait
-    run_portrait(args.image_dir, args.pool_size, args.output_file, args.stable_points)
+    run_portrait(args.image_dir, args.pool_size, args.output_file, args.stable_points,
+                 args.checkpoint_file, args.pin_targets, args.checkpoint_interval)
 
 
 def run_genvideo(args):
     from artsci2019.imagegen import run_genanimation
+    init_frame_cache(args)
     run_genanimation(args.image_dir,
-                     "temp",
+                     args.intermediate_dir,
                      args.output_file,
                      args.stack_size,
                      args.pool_size,
@@ -148,6 +394,30 @@ def run_genvideo(args):
                      args.stable_points)
 
 
+def run_rebuild_manifest(args):
+    from artsci2019.lib.image_storage import rebuild_manifest
+    rebuild_manifest(args.image_dir)
+
+
+def run_ingest(args):
+    from artsci2019.ingest import run_ingest
+    if not args.input_dir:
+        logger.error("The ingest command needs an --input_dir.")
+        return
+    run_ingest(args.input_dir, args.image_dir, args.pool_size, args.quality_filter,
+               args.image_format, args.compression)
+
+
+def run_benchmark(args):
+    from artsci2019.benchmark import run_benchmark, parse_resolutions
+    run_benchmark(args.output_file or "benchmark.json",
+                  parse_resolutions(args.bench_resolutions),
+                  [int(s) for s in args.bench_stack_sizes.split(",")],
+                  [int(s) for s in args.bench_pool_sizes.split(",")],
+                  args.bench_repeat,
+                  args.bench_baseline)
+
+
 def init_logging():
     logging.config.dictConfig({
         'version': 1,
@@ -200,6 +470,14 @@ def main():
         run_portrait(args)
     elif args.command == "gengif":
         run_genvideo(args)
+    elif args.command == "rebuildmanifest":
+        run_rebuild_manifest(args)
+    elif args.command == "ingest":
+        run_ingest(args)
+    elif args.command == "benchmark":
+        run_benchmark(args)
+    elif args.command == "renderworker":
+        run_render_worker(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,254 @@
+"""Times the hot paths of the portrait pipeline on synthetic frames and
+landmarks, so no camera or photo collection is needed.  The results are
+written as json, see run_benchmark, and can be compared to an earlier run."""
+from artsci2019.lib.portrait import get_delaunay_mapping, align_face, gen_portrait, get_target_landmarks, \
+    AlignmentPool, WARP_MODES
+from artsci2019.lib.image_storage import write_recognized_frames, read_recognized_frames
+from artsci2019.lib.frame_cache import get_frame_cache
+from artsci2019.lib.util import RecognizedFrame
+from artsci2019 import imagegen
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+DEFAULT_STACK_SIZES = [5, 10]
+DEFAULT_POOL_SIZES = [1, 4]
+
+
+def _arc(cx, cy, rx, ry, start, end, n):
+    t = np.linspace(start, end, n)
+    return np.stack([cx + rx * np.cos(t), cy + ry * np.sin(t)], axis=1)
+
+
+def _landmark_template():
+    """A frontal face in the order of face_recog._face_landmarks_to_array,
+    in coordinates relative to the face box, x and y in [0, 1]."""
+    left_eye = _arc(0.33, 0.40, 0.08, 0.03, np.pi, 2 * np.pi, 4)
+    right_eye = _arc(0.67, 0.40, 0.08, 0.03, np.pi, 2 * np.pi, 4)
+    lip_top = _arc(0.5, 0.78, 0.16, 0.05, np.pi, 2 * np.pi, 7)
+    lip_bottom = _arc(0.5, 0.78, 0.16, 0.06, 0, np.pi, 7)
+    parts = [
+        _arc(0.5, 0.45, 0.48, 0.52, np.pi, 0, 17),  # chin
+        _arc(0.31, 0.32, 0.14, 0.05, np.pi, 2 * np.pi, 5),  # left eyebrow
+        _arc(0.69, 0.32, 0.14, 0.05, np.pi, 2 * np.pi, 5),  # right eyebrow
+        np.stack([np.full(4, 0.5), np.linspace(0.40, 0.58, 4)], axis=1),  # nose bridge
+        _arc(0.5, 0.58, 0.08, 0.04, np.pi, 0, 5),  # nose tip
+        np.concatenate([left_eye, left_eye[2:0:-1] * [1, -1] + [0, 0.80]]),  # left eye
+        np.concatenate([right_eye, right_eye[2:0:-1] * [1, -1] + [0, 0.80]]),  # right eye
+        np.concatenate([lip_top, _arc(0.5, 0.78, 0.10, 0.02, 2 * np.pi, np.pi, 5)]),  # top lip
+        np.concatenate([lip_bottom, _arc(0.5, 0.78, 0.10, 0.02, 0, np.pi, 5)]),  # bottom lip
+    ]
+    return np.concatenate(parts)
+
+
+def synthetic_landmarks(frame_w, frame_h, rng, jitter=0.01):
+    """Landmarks of a face roughly in the middle of the frame, moved, scaled,
+    tilted and distorted a little at random."""
+    size = min(frame_w, frame_h) * rng.uniform(0.35, 0.45)
+    angle = rng.uniform(-0.1, 0.1)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    points = (_landmark_template() - 0.5 + rng.normal(0, jitter, (72, 2))) @ rotation.T * size
+    centre = np.array([frame_w, frame_h]) / 2 + rng.uniform(-0.05, 0.05, 2) * [frame_w, frame_h]
+    return (points + centre).astype(np.int32)
+
+
+def synthetic_frame(frame_w, frame_h, rng):
+    """A smooth random image, compresses about as well as a photo."""
+    small = rng.integers(0, 256, (frame_h // 32 + 1, frame_w // 32 + 1, 3), dtype=np.uint8)
+    frame = cv2.resize(small, (frame_w, frame_h), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(-8, 9, frame.shape)
+    return np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_recognized_frames(count, frame_w, frame_h, seed=0):
+    rng = np.random.default_rng(seed)
+    return [RecognizedFrame(synthetic_frame(frame_w, frame_h, rng), synthetic_landmarks(frame_w, frame_h, rng))
+            for _ in range(count)]
+
+
+def max_rss_mb():
+    """The most resident memory this process used over its whole run, and
+    the most any single one of its children used, counting only children
+    that have exited, like the workers of a closed AlignmentPool.  Both are
+    high-water marks, so they say nothing about a single benchmark."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"process": round(own, 1), "largest_exited_child": round(children, 1)}
+
+
+def time_it(f, repeat, warmup=1):
+    for _ in range(warmup):
+        f()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Benchmark:
+
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, name, params, f, warmup=1):
+        times = time_it(f, self.repeat, warmup)
+        result = {
+            "name": name,
+            "params": params,
+            "times": times,
+            "min": min(times),
+            "mean": statistics.mean(times),
+            "median": statistics.median(times),
+        }
+        logger.info("{} {}: median {:.4f} s".format(name, params, result["median"]))
+        self.results.append(result)
+        return result
+
+
+def bench_triangulation(bench, rfs, frame_w, frame_h, params):
+    targets = get_target_landmarks(rfs)
+    bench.run("get_delaunay_mapping", params,
+              lambda: get_delaunay_mapping(rfs[0].face_landmarks, targets, frame_w, frame_h))
+
+
+def bench_align_face(bench, rfs, params):
+    targets = get_target_landmarks(rfs)
+    for warp_mode in WARP_MODES:
+        bench.run("align_face", dict(params, warp_mode=warp_mode),
+                  lambda: align_face(rfs[0].frame, rfs[0].face_landmarks, targets, [], warp_mode))
+
+
+def bench_gen_portrait(bench, rfs, stack_size, pool_size, alignment_pool, params):
+    bench.run("gen_portrait", dict(params, stack_size=stack_size, pool_size=pool_size),
+              lambda: gen_portrait(rfs[:stack_size], pool_size, [], alignment_pool=alignment_pool))
+
+
+def bench_gen_portraits(bench, rfs, stack_size, pool_size, alignment_pool, params):
+    bench.run("gen_portraits", dict(params, stack_size=stack_size, pool_size=pool_size, frames=len(rfs)),
+              lambda: imagegen.gen_portraits(rfs, stack_size, pool_size, False, [], alignment_pool),
+              warmup=0)
+
+
+def bench_read_recognized_frames(bench, rfs, params, image_format="png"):
+    directory = tempfile.mkdtemp(prefix="fotc-benchmark-")
+    try:
+        write_recognized_frames(directory, rfs, image_format)
+
+        def read():
+            get_frame_cache().clear()
+            for rf in read_recognized_frames(directory):
+                rf.frame
+        bench.run("read_recognized_frames", dict(params, frames=len(rfs), image_format=image_format), read)
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_rpc(bench, rfs, stack_size, pool_size, params, rpc_format="jpg"):
+    """Times an update and a portrait download through a server on localhost."""
+    from werkzeug.serving import make_server
+    from artsci2019.displaybackend.rpc.server import create_app
+    from artsci2019.displaybackend.rpc.client import RemoteBackend
+    directory = tempfile.mkdtemp(prefix="fotc-benchmark-")
+    app = create_app(stack_size, pool_size, [], directory)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    remote_backend = RemoteBackend("127.0.0.1", server.port, rpc_format)
+    try:
+        # fill the window, so every update renders a full stack
+        remote_backend.update(rfs[:stack_size])
+
+        def round_trip():
+            remote_backend.update(rfs[:1])
+            remote_backend.get_portrait()
+        bench.run("rpc_round_trip", dict(params, stack_size=stack_size, pool_size=pool_size,
+                                         rpc_format=rpc_format), round_trip)
+    finally:
+        remote_backend.close()
+        server.shutdown()
+        thread.join()
+        app.extensions['backend'].close()
+        shutil.rmtree(directory)
+
+
+def run_benchmarks(resolutions=DEFAULT_RESOLUTIONS, stack_sizes=DEFAULT_STACK_SIZES, pool_sizes=DEFAULT_POOL_SIZES,
+                   repeat=3, animation_frames=20):
+    bench = Benchmark(repeat)
+    for frame_w, frame_h in resolutions:
+        params = {"resolution": "{}x{}".format(frame_w, frame_h)}
+        rfs = synthetic_recognized_frames(max(max(stack_sizes), animation_frames), frame_w, frame_h)
+        bench_triangulation(bench, rfs, frame_w, frame_h, params)
+        bench_align_face(bench, rfs, params)
+        bench_read_recognized_frames(bench, rfs[:max(stack_sizes)], params)
+        for pool_size in pool_sizes:
+            with AlignmentPool(pool_size) as alignment_pool:
+                for stack_size in stack_sizes:
+                    bench_gen_portrait(bench, rfs, stack_size, pool_size, alignment_pool, params)
+                    bench_gen_portraits(bench, rfs[:animation_frames], stack_size, pool_size, alignment_pool,
+                                        params)
+            for stack_size in stack_sizes:
+                bench_rpc(bench, rfs, stack_size, pool_size, params)
+    return bench.results
+
+
+def compare(results, baseline):
+    """Logs the speedup of every result over the same benchmark in the baseline."""
+    def key(r):
+        return r["name"], json.dumps(r["params"], sort_keys=True)
+    baseline_medians = {key(r): r["median"] for r in baseline["results"]}
+    for r in results:
+        base = baseline_medians.get(key(r))
+        if base is not None:
+            logger.info("{} {}: {:.4f} s -> {:.4f} s ({:.2f}x)".format(
+                r["name"], r["params"], base, r["median"], base / r["median"]))
+
+
+def parse_resolutions(s):
+    """Parses "640x480,1920x1080" into a list of (width, height)."""
+    return [tuple(int(v) for v in r.split("x")) for r in s.split(",") if r]
+
+
+def run_benchmark(output_file, resolutions=DEFAULT_RESOLUTIONS, stack_sizes=DEFAULT_STACK_SIZES,
+                  pool_sizes=DEFAULT_POOL_SIZES, repeat=3, baseline_file=None):
+    """Runs the benchmarks and writes the results with some information about
+    the machine to output_file."""
+    started = datetime.datetime.now()
+    results = run_benchmarks(resolutions, stack_sizes, pool_sizes, repeat)
+    report = {
+        "started": started.isoformat(),
+        "duration": (datetime.datetime.now() - started).total_seconds(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        # measured after all the pools were closed, so their workers are counted
+        "max_rss_mb": max_rss_mb(),
+        "results": results,
+    }
+    with open(output_file, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Benchmark results written to {}".format(output_file))
+    if baseline_file:
+        with open(baseline_file, "r") as f:
+            compare(results, json.load(f))
+    return report
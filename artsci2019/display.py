@@ -3,9 +3,11 @@ import cv2
 import numpy as np
 
 from artsci2019.lib.frame_checker import FrameChecker
-from artsci2019.lib.util import scale_frame, scale_point, is_in_frame
-from artsci2019.lib.face_recog import get_faces
+from artsci2019.lib.util import scale_frame, scale_point, in_frame_mask
+from artsci2019.lib.face_recog import get_faces, FaceTracker
 from artsci2019.lib.sound import SoundPlayer
+from artsci2019.lib.pipeline import CaptureThread, DetectionThread, BackgroundWorker
+from artsci2019.lib.metrics import get_metrics, enable_metrics, timed
 
 
 def draw_checked_frame(frame, checked_frame, factor):
@@ -39,9 +41,10 @@ def draw_triangles(frame, checked_frame, factor):
     # prep delaunay
     rect = (0, 0, f_w, f_h)
     subdiv = cv2.Subdiv2D(rect)
-    for lm in checked_frame.recognized_frame.face_landmarks:
-        if is_in_frame(f_w, f_h, lm):
-            subdiv.insert(lm)
+    face_landmarks = checked_frame.recognized_frame.face_landmarks
+    in_frame = face_landmarks[in_frame_mask(f_w, f_h, face_landmarks)]
+    if len(in_frame):
+        subdiv.insert(in_frame.astype(np.float32))
     print("triangles: {}".format(len(subdiv.getTriangleList())))
     for t in subdiv.getTriangleList():
         t = np.reshape(t, (3, 2)).astype(np.int32)
@@ -53,6 +56,17 @@ def draw_triangles(frame, checked_frame, factor):
         cv2.line(frame, pt3, pt1, (255, 255, 255), 1, 8, 0)
 
 
+def draw_metrics(frame, summary):
+    """Writes count, median, p99 and max in milliseconds of every stage onto the frame."""
+    lines = ["{:<16}{:>7}{:>9}{:>9}{:>9}".format("stage", "n", "p50 ms", "p99 ms", "max ms")]
+    for stage, s in summary.items():
+        lines.append("{:<16}{:>7}{:>9.1f}{:>9.1f}{:>9.1f}".format(
+            stage, s["count"], s["p50"] * 1000, s["p99"] * 1000, s["max"] * 1000))
+    for i, line in enumerate(lines):
+        cv2.putText(frame, line, (10, 25 + 22 * i), cv2.FONT_HERSHEY_PLAIN, 1.2, (0, 0, 0), 3)
+        cv2.putText(frame, line, (10, 25 + 22 * i), cv2.FONT_HERSHEY_PLAIN, 1.2, (255, 255, 255), 1)
+
+
 def my_get_frame(video_capture, rotate):
     # get a single frame
     rval, frame = video_capture.read()
@@ -65,7 +79,14 @@ def my_get_frame(video_capture, rotate):
 
 
 class InteractiveDisplay:
-    def __init__(self, camera_number, rotate, fullscreen, processing_backend):
+    def __init__(self, camera_number, rotate, fullscreen, processing_backend, pipelined=False, render_fps=20,
+                 tracking=False, metrics_overlay=False):
+        """With pipelined, capturing, face detection and rendering run at their own
+        rates on separate threads, see start_pipelined.
+        With tracking, faces are searched around their last position, see FaceTracker,
+        which is cheap enough to detect on every frame while a face is tracked.
+        With metrics_overlay, the timings of the pipeline stages are shown on the
+        preview, the m key switches the overlay on and off."""
         self.camera_number = camera_number
         self.rotate = rotate
         self.fullscreen = fullscreen
@@ -83,6 +104,16 @@ class InteractiveDisplay:
         self.checkpoint_time = datetime.datetime.now() + datetime.timedelta(seconds=10)
         self.frame_checker = None
         self.sound_player = SoundPlayer("bing.wav")
+        self.pipelined = pipelined
+        self.render_fps = render_fps
+        self.capture_thread = None
+        self.detection_thread = None
+        self.face_tracker = FaceTracker(self.scaling_factor) if tracking else None
+        self.portrait_worker = BackgroundWorker(self.render_portrait, "PortraitWorker",
+                                                merge=lambda waiting, new: waiting + new)
+        self.metrics_overlay = metrics_overlay
+        if metrics_overlay:
+            enable_metrics()
 
     def init(self):
         # initialize window
@@ -111,15 +142,48 @@ class InteractiveDisplay:
         else:
             self.frame_checker = FrameChecker(1920, 1080)
 
+        self.portrait_worker.start()
+        self.sound_player.open()
+
         return rval
 
     def teardown(self):
+        # let a running render finish before the backend is closed
+        self.portrait_worker.stop()
+        self.portrait_worker.join()
+
         cv2.destroyWindow(self.preview_window)
         cv2.destroyWindow(self.genimage_window)
 
         self.video_capture.release()
+        self.pb.close()
+        print("Sound latency: {}".format(self.sound_player.latency_stats()))
+        self.sound_player.close()
+
+    def render_portrait(self, ok_frames):
+        """Runs on the portrait worker.  Returns the new genimage or None."""
+        changed = self.pb.update(ok_frames)
+        if not changed:
+            return None
+        print("Updated")
+        portrait_frame = self.pb.get_portrait()
+        return scale_frame(portrait_frame, self.debug_scaling)
+
+    def show_portrait(self, portrait_frame):
+        """Shows a portrait as soon as the backend publishes it, like a
+        preview before the render finished.  Safe to call from any thread."""
+        self.portrait_worker.results.put(scale_frame(portrait_frame, self.debug_scaling))
+
+    def poll_portrait(self):
+        """Swaps in the new portrait once the worker has finished it."""
+        genimage = self.portrait_worker.results.take(timeout=0)
+        if genimage is not None:
+            self.genimage = genimage
 
     def portrait_update(self, checked_frames):
+        """Submits the frames to the portrait worker without waiting for the render.
+        A capture that arrives while a render is running waits for it, together
+        with the other captures that arrive in the meantime."""
         current_time = datetime.datetime.now()
         if current_time < self.checkpoint_time:
             print("too early")
@@ -128,21 +192,38 @@ class InteractiveDisplay:
         ok_frames = [cf.recognized_frame
                      for cf in checked_frames
                      if cf.all_ok]
-        changed = False
-        if ok_frames:
-            print("Updating")
-            self.sound_player.play()
-            changed = self.pb.update(ok_frames)
-        if changed:
-            print("Updated")
-            portrait_frame = self.pb.get_portrait()
-            f = scale_frame(portrait_frame, self.debug_scaling)
-            self.genimage = f
-            cv2.imshow(self.genimage_window, self.genimage)
-            self.checkpoint_time = current_time + datetime.timedelta(seconds=10)
-        return changed
-
-    def loop_update(self, frame):
+        if not ok_frames:
+            return False
+        if self.portrait_worker.busy:
+            print("Render running, queueing the capture")
+        print("Updating")
+        # the cue is for the capture, play it now and not when the render starts
+        self.sound_player.play()
+        self.portrait_worker.submit(ok_frames)
+        self.checkpoint_time = current_time + datetime.timedelta(seconds=10)
+        return True
+
+    def toggle_metrics_overlay(self):
+        """Shows or hides the stage timings, they are only collected while shown."""
+        self.metrics_overlay = not self.metrics_overlay
+        enable_metrics(self.metrics_overlay)
+        if self.metrics_overlay:
+            get_metrics().reset()
+
+    def handle_key(self, key):
+        """Returns False if the display should quit."""
+        if key == 113:  # exit on q
+            return False
+        if key == 109:  # m
+            self.toggle_metrics_overlay()
+        return True
+
+    def draw(self, frame):
+        with timed("draw"):
+            self._draw(frame)
+
+    def _draw(self, frame):
+        self.poll_portrait()
         frame = scale_frame(frame, self.debug_scaling)
         new_preview = frame
         new_genimage = self.genimage
@@ -160,14 +241,24 @@ class InteractiveDisplay:
                 print("YO")
                 draw_triangles(new_genimage, self.current_checked_frames[0], self.debug_scaling)
 
+        if self.metrics_overlay:
+            new_preview = new_preview.copy()
+            draw_metrics(new_preview, get_metrics().summary())
+
         # Display the resulting image
         cv2.imshow(self.preview_window, new_preview)
         cv2.imshow(self.genimage_window, new_genimage)
+
+    def loop_update(self, frame):
+        self.draw(frame)
         cv2.waitKey(50)
 
         changed = self.portrait_update(self.current_checked_frames)
 
     def start(self):
+        if self.pipelined:
+            return self.start_pipelined()
+
         process_this_frame = True
 
         rval = True
@@ -178,15 +269,75 @@ class InteractiveDisplay:
 
             # get the faces
             if process_this_frame:
-                rfs = get_faces(frame, self.scaling_factor)
-                self.current_checked_frames = [self.frame_checker.check(rf) for rf in rfs]
+                self.current_checked_frames = self.detect(frame)
 
-            process_this_frame = not process_this_frame
+            # while faces are tracked the tracker is cheap enough to run on every frame,
+            # without faces it searches the whole frame, so only every other one
+            tracking = self.face_tracker is not None and self.face_tracker.tracking
+            process_this_frame = not process_this_frame or tracking
 
             self.loop_update(frame)
 
             # exit on ESC
             key = cv2.waitKey(20)
-            if key == 113:  # exit on q
+            if not self.handle_key(key):
                 break
 
+    def detect(self, frame):
+        if self.face_tracker is not None:
+            rfs = self.face_tracker.get_faces(frame)
+        else:
+            rfs = get_faces(frame, self.scaling_factor)
+        return [self.frame_checker.check(rf) for rf in rfs]
+
+    def pipeline_stats(self):
+        """Queue depths and dropped frame counts of the pipelined mode."""
+        if self.capture_thread is None:
+            return {}
+        stats = {
+            "captured": self.capture_thread.captured,
+            "capture_queue": self.capture_thread.frames.depth(),
+            "capture_dropped": self.capture_thread.frames.dropped,
+            "detected": self.detection_thread.detected,
+            "detection_queue": self.detection_thread.results.depth(),
+            "detection_dropped": self.detection_thread.results.dropped,
+        }
+        if self.face_tracker is not None:
+            stats["tracking"] = self.face_tracker.stats()
+        return stats
+
+    def start_pipelined(self):
+        """A capture thread keeps only the latest camera frame, a detection
+        thread always works on the freshest frame and the render loop runs
+        at render_fps, showing the latest frame with the latest detection."""
+        self.capture_thread = CaptureThread(lambda: my_get_frame(self.video_capture, self.rotate))
+        self.detection_thread = DetectionThread(self.capture_thread.frames, self.detect)
+        self.capture_thread.start()
+        self.detection_thread.start()
+        wait_ms = max(1, int(1000 / self.render_fps))
+        stats_time = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        try:
+            while self.capture_thread.running:
+                frame, _ = self.capture_thread.frames.peek()
+                result = self.detection_thread.results.take(timeout=0)
+                if result is not None:
+                    self.current_checked_frames = result[1]
+                if frame is not None:
+                    self.draw(frame)
+                    if result is not None:
+                        # only fresh detections can trigger an update
+                        self.portrait_update(self.current_checked_frames)
+
+                current_time = datetime.datetime.now()
+                if current_time > stats_time:
+                    print("Pipeline: {}".format(self.pipeline_stats()))
+                    stats_time = current_time + datetime.timedelta(seconds=10)
+
+                key = cv2.waitKey(wait_ms)
+                if not self.handle_key(key):
+                    break
+        finally:
+            self.capture_thread.stop()
+            self.detection_thread.stop()
+            self.capture_thread.join()
+            self.detection_thread.join()
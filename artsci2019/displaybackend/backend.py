@@ -1,20 +1,79 @@
-from multiprocessing import Process
+import atexit
+import logging
+import threading
+import uuid
 from artsci2019.lib.portrait import PortraitGen
-from artsci2019.lib.image_storage import write_recognized_frames
+from artsci2019.lib.image_storage import FrameWriter
+
+
+logger = logging.getLogger(__name__)
 
 
 class Backend:
+    """Stores the recognized frames and merges them into the portrait.
+    Safe to share between threads: renders of concurrent updates are
+    coalesced by the PortraitGen, portrait reads only wait for the version
+    and the portrait to be swapped."""
 
-    def __init__(self, stack_size, pool_size, stable_points, directory):
-        self.portrait_gen = PortraitGen(stack_size, pool_size, stable_points)
+    def __init__(self, stack_size, pool_size, stable_points, directory, image_format="png", compression=None,
+                 preview_scale=None, alignment_pool=None):
+        """An alignment_pool like rpc.render_dispatch.DistributedAlignmentPool
+        can be given instead of the local pool of pool_size."""
+        self.portrait_gen = PortraitGen(stack_size, pool_size, stable_points, on_render=self._publish,
+                                        preview_scale=preview_scale, alignment_pool=alignment_pool)
         self.target_directory = directory
+        self.frame_writer = FrameWriter(directory, image_format, compression)
+        self.frame_writer_lock = threading.Lock()
+        # make sure the queued frames end up on disk
+        atexit.register(self.frame_writer.close)
+        # counts the portrait changes, waiters are notified on every change
+        self.portrait_version = 0
+        # tells the versions of this backend from those of an earlier run
+        self.instance_id = uuid.uuid4().hex[:12]
+        self.portrait = None
+        self.portrait_changed = threading.Condition()
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """Calls callback with every new portrait, including previews."""
+        self.listeners.append(callback)
+
+    def _publish(self, portrait):
+        with self.portrait_changed:
+            self.portrait_version += 1
+            self.portrait = portrait
+            self.portrait_changed.notify_all()
+        for callback in self.listeners:
+            callback(portrait)
 
     def update(self, recognized_frames):
-        p = Process(target=write_recognized_frames, args=(self.target_directory, recognized_frames))
-        p.start()
-        changed = self.portrait_gen.update(recognized_frames)
-        p.join()
-        return changed
+        """Adds the frames, returns whether the portrait changed.  Returns once
+        the portrait includes them, also if a render was running.
+        Raises a ValueError for frames that do not fit the portrait."""
+        # only frames that made it into the window are stored
+        return self.portrait_gen.update(recognized_frames, on_added=self._store)
+
+    def _store(self, recognized_frames):
+        with self.frame_writer_lock:
+            self.frame_writer.put(recognized_frames)
 
     def get_portrait(self):
-        return self.portrait_gen.portrait_frame
+        return self.portrait
+
+    def get_versioned_portrait(self):
+        """Returns the portrait together with its version."""
+        with self.portrait_changed:
+            return self.portrait_version, self.portrait
+
+    def wait_for_portrait(self, version, timeout):
+        """Blocks until there is a portrait newer than version or the timeout
+        in seconds passed.  Returns the current version and portrait."""
+        with self.portrait_changed:
+            self.portrait_changed.wait_for(lambda: self.portrait_version > version, timeout)
+            return self.portrait_version, self.portrait
+
+    def close(self):
+        with self.frame_writer_lock:
+            self.frame_writer.close()
+        self.portrait_gen.close()
+        logger.info("Portrait renders: {}".format(self.portrait_gen.stats()))
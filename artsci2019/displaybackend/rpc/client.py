@@ -1,24 +1,37 @@
 import requests
-import pickle
-import io
+from requests.adapters import HTTPAdapter
+from artsci2019.displaybackend.rpc import protocol
+from artsci2019.lib.metrics import timed
 
 
 class RemoteBackend:
 
-    def __init__(self, host, port):
-        """A wrapper for the RPC with the server"""
+    def __init__(self, host, port, image_format="jpg", quality=95, portrait_format="jpg", portrait_quality=None):
+        """A wrapper for the RPC with the server.
+        The frames are sent in the given image format at the given quality,
+        see protocol.encode_frame.  The connection is kept alive between calls.
+        Portraits are fetched in portrait_format and only if they changed."""
         self.host = host
         self.port = port
+        self.image_format = image_format
+        self.quality = quality
+        self.portrait_format = portrait_format
+        self.portrait_quality = portrait_quality
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.portrait = None
+        self.portrait_etag = None
+        self.portrait_version = None
 
     def update(self, recognized_frames):
         """Takes a list of recognized frames and adds them to the rpc."""
         url = 'http://{}:{}/update'.format(self.host, self.port)
-        bytesIO = io.BytesIO()
-        pickle.dump(recognized_frames, bytesIO)
-        bytesIO.seek(0)
-        files = {'params': bytesIO}
+        with timed("rpc_encode"):
+            data = protocol.encode_recognized_frames(recognized_frames, self.image_format, self.quality)
         print("Posting request")
-        resp = requests.post(url, files=files)
+        with timed("rpc_update"):
+            resp = self.session.post(url, data=data, headers={'Content-Type': protocol.CONTENT_TYPE})
+        resp.raise_for_status()
         if resp.content == b'False':
             return False
         elif resp.content == b'True':
@@ -26,8 +39,51 @@ class RemoteBackend:
         else:
             raise ValueError()
 
+    def _portrait_params(self):
+        params = {'format': self.portrait_format}
+        if self.portrait_quality is not None:
+            params['quality'] = self.portrait_quality
+        return params
+
+    def _handle_portrait_response(self, resp):
+        """Updates the cached portrait from the response, returns whether it changed."""
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+        self.portrait_etag = resp.headers.get('ETag')
+        self.portrait_version = resp.headers.get(protocol.VERSION_HEADER)
+        if resp.status_code == 204:
+            self.portrait = None
+            return False
+        self.portrait = protocol.decode_image(resp.content)
+        return True
+
     def get_portrait(self):
+        """Returns the current portrait.  It is only downloaded if it changed."""
         url = 'http://{}:{}/portrait'.format(self.host, self.port)
-        resp = requests.get(url)
-        frame = pickle.loads(resp.content)
-        return frame
+        headers = {}
+        if self.portrait_etag is not None and self.portrait is not None:
+            headers['If-None-Match'] = self.portrait_etag
+        with timed("rpc_portrait"):
+            resp = self.session.get(url, params=self._portrait_params(), headers=headers)
+            self._handle_portrait_response(resp)
+        return self.portrait
+
+    def wait_for_portrait(self, timeout=30):
+        """Blocks until the server has a newer portrait than the last one
+        fetched, at most for timeout seconds.  Returns the new portrait or None."""
+        url = 'http://{}:{}/portrait/wait'.format(self.host, self.port)
+        params = self._portrait_params()
+        if self.portrait_version is not None:
+            params['version'] = self.portrait_version
+        params['timeout'] = timeout
+        headers = {}
+        if self.portrait_etag is not None and self.portrait is not None:
+            headers['If-None-Match'] = self.portrait_etag
+        resp = self.session.get(url, params=params, headers=headers, timeout=timeout + 10)
+        if self._handle_portrait_response(resp):
+            return self.portrait
+        return None
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,240 @@
+"""The binary format of the update requests from the RemoteBackend to the
+server, replacing pickled RecognizedFrames.  Portraits are sent as plain
+jpg or png images, tagged with their version and the id of the backend
+instance.
+
+All numbers are little endian.  A message is a header, followed by the
+encoded frames and then the faces.  Faces from the same capture share
+their frame, so it is only sent once.
+
+    header: magic "FOTC", version (uint8), frame count (uint16),
+            face count (uint16), landmarks per face (uint16)
+    frame:  image format (uint8), length (uint32), encoded image
+    face:   frame index (uint16), landmarks (int16 x, y pairs)
+
+Render workers get the faces to align in an align request, the frames
+message preceded by the alignment parameters, and answer with the
+aligned frames as an images message:
+
+    align request: magic "FOTA", version (uint8), target count (uint16),
+                   stable point count (uint16), targets and stable points
+                   (int16 x, y pairs), frames message
+    images:        magic "FOTI", version (uint8), image count (uint16),
+                   frames as above
+"""
+import struct
+import cv2
+import numpy as np
+from artsci2019.lib.util import RecognizedFrame
+from artsci2019.lib.landmark_manifest import LANDMARK_COUNT
+
+
+MAGIC = b"FOTC"
+ALIGN_MAGIC = b"FOTA"
+IMAGES_MAGIC = b"FOTI"
+VERSION = 1
+CONTENT_TYPE = "application/x-fotc-frames"
+ALIGN_CONTENT_TYPE = "application/x-fotc-align"
+IMAGES_CONTENT_TYPE = "application/x-fotc-images"
+
+HEADER = struct.Struct("<4sBHHH")
+ALIGN_HEADER = struct.Struct("<4sBHH")
+IMAGES_HEADER = struct.Struct("<4sBH")
+FRAME_HEADER = struct.Struct("<BI")
+FACE_HEADER = struct.Struct("<H")
+
+# image format -> (code, file extension, imwrite flag of the quality parameter)
+IMAGE_FORMATS = {
+    "jpg": (1, ".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "png": (2, ".png", cv2.IMWRITE_PNG_COMPRESSION),
+}
+FORMAT_CODES = set(code for code, _, _ in IMAGE_FORMATS.values())
+IMAGE_CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+}
+
+VERSION_HEADER = "X-Portrait-Version"
+# the shared secret of a backend and its render workers
+WORKER_TOKEN_HEADER = "X-Worker-Token"
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(frame, image_format="jpg", quality=None):
+    """Returns the format code and the encoded image.  The quality is the
+    jpg quality or the png compression level, None for the OpenCV default."""
+    code, ext, quality_flag = IMAGE_FORMATS[image_format]
+    params = [quality_flag, quality] if quality is not None else []
+    ok, data = cv2.imencode(ext, frame, params)
+    if not ok:
+        raise ProtocolError("Could not encode the frame as {}".format(image_format))
+    return code, data.tobytes()
+
+
+def encode_recognized_frames(recognized_frames, image_format="jpg", quality=None):
+    """Encodes a list of recognized frames into a message."""
+    frame_ids = {}
+    frames = []
+    faces = []
+    landmark_count = len(recognized_frames[0].face_landmarks) if recognized_frames else 0
+    for rf in recognized_frames:
+        frame = rf.frame
+        if id(frame) not in frame_ids:
+            frame_ids[id(frame)] = len(frames)
+            frames.append(encode_frame(frame, image_format, quality))
+        landmarks = rf.face_landmarks
+        if landmarks.shape != (landmark_count, 2):
+            raise ProtocolError("All faces need the same number of landmarks.")
+        if landmarks.min(initial=0) < -2 ** 15 or landmarks.max(initial=0) >= 2 ** 15:
+            raise ProtocolError("Landmarks out of range.")
+        faces.append((frame_ids[id(frame)], landmarks.astype("<i2")))
+
+    parts = [HEADER.pack(MAGIC, VERSION, len(frames), len(faces), landmark_count)]
+    for code, data in frames:
+        parts.append(FRAME_HEADER.pack(code, len(data)))
+        parts.append(data)
+    for frame_index, landmarks in faces:
+        parts.append(FACE_HEADER.pack(frame_index))
+        parts.append(landmarks.tobytes())
+    return b"".join(parts)
+
+
+def portrait_version(instance_id, version):
+    """The version of a portrait as sent to clients.  It includes the id of
+    the backend instance, as the version counter starts over with every run."""
+    return "{}-{}".format(instance_id, version)
+
+
+def parse_portrait_version(s, instance_id):
+    """Returns the version counter of a version from portrait_version, or
+    None if it is from another backend instance or malformed."""
+    instance, _, version = (s or "").rpartition("-")
+    if instance != instance_id or not version.isdigit():
+        return None
+    return int(version)
+
+
+def portrait_etag(instance_id, version, image_format, quality=None):
+    """The ETag of a portrait encoded in the image format at the quality."""
+    return '"portrait-{}-{}-{}"'.format(portrait_version(instance_id, version), image_format,
+                                        "default" if quality is None else quality)
+
+
+def decode_image(data):
+    frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ProtocolError("Could not decode the image.")
+    return frame
+
+
+def _read(data, offset, size):
+    if offset + size > len(data):
+        raise ProtocolError("Message truncated.")
+    return data[offset:offset + size], offset + size
+
+
+def decode_recognized_frames(data):
+    """Decodes a message into a list of recognized frames.  Raises a
+    ProtocolError for anything that is not a well formed message."""
+    header, offset = _read(data, 0, HEADER.size)
+    magic, version, frame_count, face_count, landmark_count = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Not a frames message.")
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version: {}".format(version))
+
+    frames = []
+    for _ in range(frame_count):
+        frame_header, offset = _read(data, offset, FRAME_HEADER.size)
+        code, length = FRAME_HEADER.unpack(frame_header)
+        if code not in FORMAT_CODES:
+            raise ProtocolError("Unknown image format: {}".format(code))
+        encoded, offset = _read(data, offset, length)
+        frames.append(decode_image(encoded))
+
+    if face_count and landmark_count != LANDMARK_COUNT:
+        raise ProtocolError("Expected {} landmarks per face, got {}".format(LANDMARK_COUNT, landmark_count))
+    rfs = []
+    landmarks_size = landmark_count * 2 * 2
+    for _ in range(face_count):
+        face_header, offset = _read(data, offset, FACE_HEADER.size)
+        frame_index, = FACE_HEADER.unpack(face_header)
+        if frame_index >= len(frames):
+            raise ProtocolError("Face refers to a missing frame.")
+        encoded, offset = _read(data, offset, landmarks_size)
+        landmarks = np.frombuffer(encoded, dtype="<i2").reshape(landmark_count, 2)
+        rfs.append(RecognizedFrame(frames[frame_index], landmarks.astype(np.int32)))
+    if offset != len(data):
+        raise ProtocolError("Trailing data after the message.")
+    return rfs
+
+
+def _encode_points(points):
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    if points.min(initial=0) < -2 ** 15 or points.max(initial=0) >= 2 ** 15:
+        raise ProtocolError("Points out of range.")
+    return points.astype("<i2").tobytes()
+
+
+def _decode_points(data, offset, count):
+    encoded, offset = _read(data, offset, count * 2 * 2)
+    return np.frombuffer(encoded, dtype="<i2").reshape(count, 2).astype(np.int32), offset
+
+
+def _check_header(magic, version, expected_magic):
+    if magic != expected_magic:
+        raise ProtocolError("Unexpected message type.")
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version: {}".format(version))
+
+
+def encode_align_request(recognized_frames, target_landmarks, stable_points, image_format="jpg", quality=None):
+    """Encodes the faces to align to the target landmarks for a render worker."""
+    target_landmarks = np.asarray(target_landmarks).reshape(-1, 2)
+    stable_points = np.asarray(stable_points, dtype=np.int64).reshape(-1, 2)
+    return b"".join([ALIGN_HEADER.pack(ALIGN_MAGIC, VERSION, len(target_landmarks), len(stable_points)),
+                     _encode_points(target_landmarks),
+                     _encode_points(stable_points),
+                     encode_recognized_frames(recognized_frames, image_format, quality)])
+
+
+def decode_align_request(data):
+    """Returns the recognized frames, the target landmarks and the stable points of an align request."""
+    header, offset = _read(data, 0, ALIGN_HEADER.size)
+    magic, version, target_count, stable_count = ALIGN_HEADER.unpack(header)
+    _check_header(magic, version, ALIGN_MAGIC)
+    target_landmarks, offset = _decode_points(data, offset, target_count)
+    stable_points, offset = _decode_points(data, offset, stable_count)
+    recognized_frames = decode_recognized_frames(data[offset:])
+    if any(len(rf.face_landmarks) != target_count for rf in recognized_frames):
+        raise ProtocolError("The faces and the targets have different numbers of landmarks.")
+    return recognized_frames, target_landmarks, [tuple(p) for p in stable_points.tolist()]
+
+
+def encode_images(frames, image_format="jpg", quality=None):
+    parts = [IMAGES_HEADER.pack(IMAGES_MAGIC, VERSION, len(frames))]
+    for frame in frames:
+        code, data = encode_frame(frame, image_format, quality)
+        parts.append(FRAME_HEADER.pack(code, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_images(data):
+    header, offset = _read(data, 0, IMAGES_HEADER.size)
+    magic, version, count = IMAGES_HEADER.unpack(header)
+    _check_header(magic, version, IMAGES_MAGIC)
+    frames = []
+    for _ in range(count):
+        frame_header, offset = _read(data, offset, FRAME_HEADER.size)
+        code, length = FRAME_HEADER.unpack(frame_header)
+        if code not in FORMAT_CODES:
+            raise ProtocolError("Unknown image format: {}".format(code))
+        encoded, offset = _read(data, offset, length)
+        frames.append(decode_image(encoded))
+    if offset != len(data):
+        raise ProtocolError("Trailing data after the message.")
+    return frames
@@ -0,0 +1,291 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from artsci2019.displaybackend.rpc import protocol
+
+
+logger = logging.getLogger(__name__)
+
+# registered workers are dropped if they did not register again for this many seconds
+WORKER_TTL = 30
+# a worker that failed is not used for this many seconds
+RETRY_DELAY = 30
+REQUEST_TIMEOUT = 30
+
+
+class RemoteRenderWorker:
+    """A render worker on another host, see render_worker.create_worker_app.
+    Keeps track of its load and of how long it takes per face."""
+
+    def __init__(self, url, capacity, static=False):
+        self.url = url
+        self.capacity = max(int(capacity), 1)
+        self.static = static
+        self.last_seen = time.time()
+        self.down_until = 0
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.seconds_per_face = None
+        self.faces = 0
+        self.failures = 0
+
+    def estimated_finish(self, assigned):
+        """Seconds until this worker would be done with assigned more faces.
+        Until a batch was timed, a worker is assumed to take a second per
+        face on each of its processes."""
+        seconds_per_face = self.seconds_per_face if self.seconds_per_face is not None else 1.0 / self.capacity
+        return (self.in_flight + assigned + 1) * seconds_per_face
+
+    def started(self, faces):
+        with self.lock:
+            self.in_flight += faces
+
+    def finished(self, faces):
+        with self.lock:
+            self.in_flight -= faces
+
+    def record(self, faces, seconds):
+        """Updates the average time per face from the time a batch of faces took."""
+        per_face = seconds / faces
+        with self.lock:
+            if self.seconds_per_face is None:
+                self.seconds_per_face = per_face
+            else:
+                self.seconds_per_face = 0.8 * self.seconds_per_face + 0.2 * per_face
+            self.faces += faces
+
+    def stats(self):
+        return {"url": self.url, "capacity": self.capacity, "in_flight": self.in_flight,
+                "seconds_per_face": self.seconds_per_face, "faces": self.faces, "failures": self.failures,
+                "up": time.time() >= self.down_until}
+
+
+class LocalRenderWorker(RemoteRenderWorker):
+    """Stands for the local alignment pool in the load balancing."""
+
+    def __init__(self, pool_size):
+        super().__init__("local", pool_size, static=True)
+
+
+class RenderWorkerRegistry:
+    """The render workers a backend can use.  Workers are given up front or
+    register themselves, registered workers have to register again within
+    WORKER_TTL seconds to stay in the registry."""
+
+    def __init__(self, worker_addresses=[]):
+        self.lock = threading.Lock()
+        self.workers = {}
+        for address in worker_addresses:
+            url = 'http://{}'.format(address)
+            self.workers[url] = RemoteRenderWorker(url, 1, static=True)
+
+    def register(self, url, capacity):
+        with self.lock:
+            worker = self.workers.get(url)
+            if worker is None:
+                logger.info("Render worker {} registered with capacity {}.".format(url, capacity))
+                worker = self.workers[url] = RemoteRenderWorker(url, capacity)
+            worker.capacity = max(int(capacity), 1)
+            worker.last_seen = time.time()
+
+    def live_workers(self):
+        now = time.time()
+        with self.lock:
+            for url, worker in list(self.workers.items()):
+                if not worker.static and now - worker.last_seen > WORKER_TTL:
+                    logger.warning("Render worker {} stopped registering, dropping it.".format(url))
+                    del self.workers[url]
+            return [w for w in self.workers.values() if now >= w.down_until]
+
+    def failed(self, worker):
+        with self.lock:
+            worker.failures += 1
+            worker.down_until = time.time() + RETRY_DELAY
+
+    def stats(self):
+        with self.lock:
+            return [w.stats() for w in self.workers.values()]
+
+
+class DistributedAlignmentJob:
+    """An alignment job spread over the local pool and render workers,
+    used like an AlignmentJob."""
+
+    def __init__(self, dispatcher, recognized_frames, target_landmarks, stable_points, triangulation_cache,
+                 local_indices, local_job, remote_parts, local_start=None):
+        self.dispatcher = dispatcher
+        self.recognized_frames = recognized_frames
+        self.target_landmarks = target_landmarks
+        self.stable_points = stable_points
+        self.triangulation_cache = triangulation_cache
+        self.local_indices = local_indices
+        self.local_job = local_job
+        # when the local part was submitted, it is timed from there
+        self.local_start = local_start
+        self.remote_parts = remote_parts  # [(worker, indices, future)]
+        self.out = None
+        self.local_done = False
+
+    def ready(self):
+        return ((self.local_job is None or self.local_job.ready())
+                and all(future.done() for _, _, future in self.remote_parts))
+
+    def wait(self):
+        if self.out is not None:
+            return self.out
+        try:
+            self.out = self._assemble()
+        except BaseException:
+            # nothing of the job is left running or held
+            self.release()
+            wait_futures([future for _, _, future in self.remote_parts])
+            raise
+        return self.out
+
+    def _assemble(self):
+        shape = self.recognized_frames[0].frame.shape
+        out = np.empty((len(self.recognized_frames),) + shape, dtype=np.uint8)
+        if self.local_job is not None:
+            out[self.local_indices] = self.local_job.wait()
+            self._local_finished()
+            self.dispatcher.local_worker.record(len(self.local_indices), time.perf_counter() - self.local_start)
+        for worker, indices, future in self.remote_parts:
+            try:
+                aligned = future.result()
+            except Exception as e:
+                logger.warning("Render worker {} failed: {}".format(worker.url, e))
+                self.dispatcher.registry.failed(worker)
+                aligned = self.dispatcher.retry([self.recognized_frames[i] for i in indices], self.target_landmarks,
+                                                self.stable_points, self.triangulation_cache, worker)
+            out[indices] = aligned
+        return out
+
+    def _local_finished(self):
+        if not self.local_done:
+            self.local_done = True
+            self.dispatcher.local_worker.finished(len(self.local_indices))
+
+    def release(self):
+        for _, _, future in self.remote_parts:
+            future.cancel()
+        if self.local_job is not None:
+            self.local_job.release()
+            self._local_finished()
+            self.local_job = None
+
+
+class DistributedAlignmentPool:
+    """Aligns faces like an AlignmentPool, but spreads them over the local
+    pool and the live render workers of the registry.  Every face goes to
+    the worker expected to finish it first, judged by its capacity, its
+    faces in flight and its measured time per face.  Faces of a worker
+    that fails are retried on another worker or the local pool, which
+    also does all the work while there are no workers."""
+
+    def __init__(self, local_pool, registry, image_format="jpg", quality=95, token=None):
+        """The token is sent to the workers with every request, see
+        render_worker.create_worker_app."""
+        self.local_pool = local_pool
+        self.registry = registry
+        self.image_format = image_format
+        self.quality = quality
+        self.headers = {'Content-Type': protocol.ALIGN_CONTENT_TYPE}
+        if token is not None:
+            self.headers[protocol.WORKER_TOKEN_HEADER] = token
+        self.local_worker = LocalRenderWorker(local_pool.pool_size)
+        self.executor = ThreadPoolExecutor(8, thread_name_prefix="RenderDispatch")
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=8))
+
+    @property
+    def pool_size(self):
+        return self.local_pool.pool_size
+
+    def _assign(self, count, workers):
+        """Returns the face indices for each worker."""
+        assigned = {w: [] for w in workers}
+        for i in range(count):
+            worker = min(workers, key=lambda w: w.estimated_finish(len(assigned[w])))
+            assigned[worker].append(i)
+        return assigned
+
+    def _align_remote(self, worker, recognized_frames, target_landmarks, stable_points):
+        data = protocol.encode_align_request(recognized_frames, target_landmarks, stable_points,
+                                             self.image_format, self.quality)
+        worker.started(len(recognized_frames))
+        start = time.perf_counter()
+        try:
+            resp = self.session.post(worker.url + '/align', data=data, timeout=REQUEST_TIMEOUT, headers=self.headers)
+            resp.raise_for_status()
+            aligned = protocol.decode_images(resp.content)
+        finally:
+            worker.finished(len(recognized_frames))
+        if len(aligned) != len(recognized_frames):
+            raise protocol.ProtocolError("Got {} of {} aligned faces.".format(len(aligned), len(recognized_frames)))
+        worker.record(len(recognized_frames), time.perf_counter() - start)
+        return np.stack(aligned)
+
+    def submit(self, recognized_frames, target_landmarks, stable_points, triangulation_cache=None, keep=None):
+        workers = self.registry.live_workers()
+        if not workers:
+            return self.local_pool.submit(recognized_frames, target_landmarks, stable_points, triangulation_cache,
+                                          keep)
+        assigned = self._assign(len(recognized_frames), [self.local_worker] + workers)
+        local_indices = assigned.pop(self.local_worker)
+        remote_parts = []
+        for worker, indices in assigned.items():
+            if indices:
+                future = self.executor.submit(self._align_remote, worker, [recognized_frames[i] for i in indices],
+                                              target_landmarks, stable_points)
+                remote_parts.append((worker, indices, future))
+        local_job = None
+        local_start = time.perf_counter()
+        if local_indices:
+            self.local_worker.started(len(local_indices))
+            # the faces sent to workers may be assigned to the local pool next time
+            local_job = self.local_pool.submit([recognized_frames[i] for i in local_indices], target_landmarks,
+                                               stable_points, triangulation_cache,
+                                               list(recognized_frames) + list(keep or []))
+        return DistributedAlignmentJob(self, recognized_frames, target_landmarks, stable_points, triangulation_cache,
+                                       local_indices, local_job, remote_parts, local_start)
+
+    def retry(self, recognized_frames, target_landmarks, stable_points, triangulation_cache, failed_worker):
+        """Aligns the faces of a failed worker on another live worker, or locally."""
+        for worker in self.registry.live_workers():
+            if worker is failed_worker:
+                continue
+            try:
+                return self._align_remote(worker, recognized_frames, target_landmarks, stable_points)
+            except Exception as e:
+                logger.warning("Render worker {} failed: {}".format(worker.url, e))
+                self.registry.failed(worker)
+        self.local_worker.started(len(recognized_frames))
+        try:
+            aligned = self.local_pool.align(recognized_frames, target_landmarks, stable_points, triangulation_cache)
+        finally:
+            self.local_worker.finished(len(recognized_frames))
+        return aligned.copy()
+
+    def align(self, recognized_frames, target_landmarks, stable_points, triangulation_cache=None):
+        job = self.submit(recognized_frames, target_landmarks, stable_points, triangulation_cache)
+        aligned = job.wait()
+        job.release()
+        return aligned
+
+    def stats(self):
+        return {"local": self.local_worker.stats(), "workers": self.registry.stats()}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        self.local_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
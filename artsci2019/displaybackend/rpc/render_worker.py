@@ -0,0 +1,96 @@
+import hmac
+import logging
+import threading
+import requests
+from flask import Flask
+from flask import request
+from artsci2019.lib.portrait import AlignmentPool, TriangulationCache
+from artsci2019.displaybackend.rpc import protocol
+
+
+logger = logging.getLogger(__name__)
+
+REGISTER_INTERVAL = 10
+
+
+def token_ok(token, given):
+    """Whether a request carries the shared token, always true without one."""
+    return token is None or (given is not None and hmac.compare_digest(token.encode(), given.encode()))
+
+
+def create_worker_app(pool_size, image_format="jpg", quality=95, token=None):
+    """Returns a flask app that aligns faces for a backend, see
+    render_dispatch.RemoteRenderWorker.  The aligned frames are sent back
+    in the given image format and quality.  With a token, only requests
+    carrying it in the WORKER_TOKEN_HEADER are served."""
+    app = Flask(__name__)
+    alignment_pool = AlignmentPool(pool_size)
+    triangulation_cache = TriangulationCache(256)
+    # the pool serves one request at a time, all its workers align the faces of that request
+    lock = threading.Lock()
+    stats = {"requests": 0, "faces": 0}
+
+    @app.route('/align', methods=['POST'])
+    def align():
+        if not token_ok(token, request.headers.get(protocol.WORKER_TOKEN_HEADER)):
+            return 'ERROR', 403
+        if request.mimetype != protocol.ALIGN_CONTENT_TYPE:
+            return 'ERROR', 415
+        try:
+            recognized_frames, target_landmarks, stable_points = protocol.decode_align_request(request.get_data())
+        except protocol.ProtocolError as e:
+            app.logger.warning("Invalid align request: {}".format(e))
+            return 'ERROR', 400
+        if not recognized_frames:
+            return 'ERROR', 400
+        with lock:
+            aligned = alignment_pool.align(recognized_frames, target_landmarks, stable_points, triangulation_cache)
+            data = protocol.encode_images(aligned, image_format, quality)
+            stats["requests"] += 1
+            stats["faces"] += len(recognized_frames)
+        return data, 200, {'Content-Type': protocol.IMAGES_CONTENT_TYPE}
+
+    @app.route('/status', methods=['GET'])
+    def status():
+        return dict(stats, capacity=pool_size)
+
+    app.extensions['alignment_pool'] = alignment_pool
+    return app
+
+
+class Registration:
+    """Announces a render worker to a backend every interval seconds, which
+    also tells the backend the worker is still alive.  The backend only
+    accepts workers that know its token."""
+
+    def __init__(self, backend_address, worker_url, capacity, token, interval=REGISTER_INTERVAL):
+        self.url = 'http://{}/workers/register'.format(backend_address)
+        self.worker_url = worker_url
+        self.capacity = capacity
+        self.token = token
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="WorkerRegistration", daemon=True)
+        self.registered = False
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                resp = requests.post(self.url, json={"url": self.worker_url, "capacity": self.capacity},
+                                     headers={protocol.WORKER_TOKEN_HEADER: self.token}, timeout=5)
+                resp.raise_for_status()
+                if not self.registered:
+                    logger.info("Registered with the backend at {}.".format(self.url))
+                self.registered = True
+            except requests.RequestException as e:
+                if self.registered:
+                    logger.warning("Could not register with the backend: {}".format(e))
+                self.registered = False
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
@@ -1,31 +1,167 @@
+import logging
+import threading
 from flask import Flask
 from flask import request
 from artsci2019.displaybackend.backend import Backend
-import pickle
+from artsci2019.displaybackend.rpc import protocol
+from artsci2019.displaybackend.rpc.render_dispatch import DistributedAlignmentPool
+from artsci2019.displaybackend.rpc.render_worker import token_ok
+from artsci2019.lib.portrait import AlignmentPool
+from artsci2019.lib.metrics import get_metrics, enable_metrics
 
 
-def create_app(stack_size, thread_count, stable_points, directory):
-    """Returns a flask app provinding two api endpoints.
-    The server communicates with the RemoteBackend in client.py."""
+logger = logging.getLogger(__name__)
+
+MAX_WAIT_SECONDS = 60
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+def create_app(stack_size, thread_count, stable_points, directory, image_format="png", compression=None,
+               max_request_bytes=MAX_REQUEST_BYTES, preview_scale=None, render_workers=None,
+               rpc_format="jpg", rpc_quality=95, worker_token=None):
+    """Returns a flask app provinding the api endpoints.
+    The server communicates with the RemoteBackend in client.py.
+    Larger requests than max_request_bytes are refused with 413.
+    With a render_dispatch.RenderWorkerRegistry as render_workers, the faces
+    are aligned by its workers too, sent to them in rpc_format and rpc_quality.
+    With a worker_token, workers that send it can register on /workers/register,
+    and it is sent along with the faces."""
     app = Flask(__name__)
-    backend = Backend(stack_size, thread_count, stable_points, directory)
+    app.config['MAX_CONTENT_LENGTH'] = max_request_bytes
+    alignment_pool = None
+    if render_workers is not None:
+        alignment_pool = DistributedAlignmentPool(AlignmentPool(thread_count), render_workers,
+                                                  rpc_format, rpc_quality, worker_token)
+    backend = Backend(stack_size, thread_count, stable_points, directory, image_format, compression,
+                      preview_scale, alignment_pool)
+    # (version, format, quality) -> encoded portrait, only for the latest version
+    encoded_portraits = {}
+    encoded_portraits_lock = threading.Lock()
+
+    def encode_portrait(version, portrait, portrait_format, quality):
+        key = (version, portrait_format, quality)
+        with encoded_portraits_lock:
+            data = encoded_portraits.get(key)
+        if data is None:
+            _, data = protocol.encode_frame(portrait, portrait_format, quality)
+            with encoded_portraits_lock:
+                if all(k[0] <= version for k in encoded_portraits):
+                    for old_key in [k for k in encoded_portraits if k[0] != version]:
+                        del encoded_portraits[old_key]
+                    encoded_portraits[key] = data
+        return data
+
+    def portrait_response(version, portrait):
+        """Answers with the encoded portrait, or 304 if the client has this version."""
+        portrait_format = request.args.get('format', 'jpg')
+        if portrait_format not in protocol.IMAGE_FORMATS:
+            return 'ERROR', 400
+        quality = request.args.get('quality', None, type=int)
+        # every format and quality is a representation of its own
+        etag = protocol.portrait_etag(backend.instance_id, version, portrait_format, quality)
+        headers = {'ETag': etag, protocol.VERSION_HEADER: protocol.portrait_version(backend.instance_id, version)}
+        if portrait is None:
+            return '', 204, headers
+        if request.headers.get('If-None-Match') == etag:
+            return '', 304, headers
+        data = encode_portrait(version, portrait, portrait_format, quality)
+        headers['Content-Type'] = protocol.IMAGE_CONTENT_TYPES[portrait_format]
+        return data, 200, headers
 
     @app.route('/update', methods=['POST'])
     def update():
         # check if everything is okay
         if not request.method == 'POST':
             return 'ERROR'
-        if 'params' not in request.files:
-            return 'ERROR'
+        if request.mimetype != protocol.CONTENT_TYPE:
+            return 'ERROR', 415
         # unpack params
-        pickled_params = request.files['params']
-        recognized_frames = pickle.load(pickled_params)
-        changed = backend.update(recognized_frames)
+        try:
+            recognized_frames = protocol.decode_recognized_frames(request.get_data())
+        except protocol.ProtocolError as e:
+            app.logger.warning("Invalid update request: {}".format(e))
+            return 'ERROR', 400
+        try:
+            changed = backend.update(recognized_frames)
+        except ValueError as e:
+            app.logger.warning("Rejected update: {}".format(e))
+            return 'ERROR', 400
         return str(changed)
 
     @app.route('/portrait', methods=['GET'])
     def get_portrait():
-        s = pickle.dumps(backend.get_portrait())
-        return s
+        return portrait_response(*backend.get_versioned_portrait())
+
+    @app.route('/portrait/wait', methods=['GET'])
+    def wait_for_portrait():
+        """Long poll: blocks until there is a portrait newer than the version
+        parameter, at most for timeout seconds.  A version of an earlier run
+        of the server is answered at once."""
+        version = 0
+        if 'version' in request.args:
+            version = protocol.parse_portrait_version(request.args['version'], backend.instance_id)
+            if version is None:
+                version = -1
+        timeout = min(request.args.get('timeout', 30, type=float), MAX_WAIT_SECONDS)
+        return portrait_response(*backend.wait_for_portrait(version, timeout))
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """The stage timings in the Prometheus text format, or as json with format=json."""
+        if request.args.get('format') == 'json':
+            return {"enabled": get_metrics().enabled,
+                    "stages": get_metrics().summary(),
+                    "renders": backend.portrait_gen.stats()}
+        return get_metrics().prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    @app.route('/metrics/enabled', methods=['POST'])
+    def set_metrics_enabled():
+        """Switches collecting the timings on or off, with enabled=true or false."""
+        enabled = request.args.get('enabled', 'true').lower() in ('1', 'true', 'on')
+        enable_metrics(enabled)
+        return str(enabled)
+
+    @app.route('/workers/register', methods=['POST'])
+    def register_worker():
+        """Adds a render worker, or tells that it is still alive.  Expects json
+        with the url of the worker and its capacity, its number of processes.
+        The faces of visitors are sent to the workers, so only workers with
+        the token are accepted."""
+        if render_workers is None or worker_token is None:
+            return 'ERROR', 404
+        if not token_ok(worker_token, request.headers.get(protocol.WORKER_TOKEN_HEADER)):
+            app.logger.warning("Render worker registration from {} with a wrong token.".format(request.remote_addr))
+            return 'ERROR', 403
+        params = request.get_json(silent=True)
+        if not isinstance(params, dict) or not isinstance(params.get('url'), str):
+            return 'ERROR', 400
+        try:
+            capacity = int(params.get('capacity', 1))
+        except (TypeError, ValueError):
+            return 'ERROR', 400
+        render_workers.register(params['url'].rstrip('/'), capacity)
+        return 'OK'
+
+    @app.route('/workers', methods=['GET'])
+    def workers():
+        if alignment_pool is None:
+            return 'ERROR', 404
+        return alignment_pool.stats()
+
+    app.extensions['backend'] = backend
     return app
+
+
+def serve(app, host, port, threads=8, max_request_bytes=MAX_REQUEST_BYTES):
+    """Runs the app on a multithreaded production server.
+    All threads share the one Backend of the app, so the server runs in a
+    single process; long polling requests each keep a thread busy."""
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        logger.warning("waitress is not installed, falling back to the threaded werkzeug server.")
+        from werkzeug.serving import run_simple
+        run_simple(host, port, app, threaded=True)
+        return
+    logger.info("Serving on {}:{} with {} threads.".format(host, port, threads))
+    waitress_serve(app, host=host, port=port, threads=threads, max_request_body_size=max_request_bytes)
@@ -1,38 +1,98 @@
-from artsci2019.lib.portrait import gen_portrait
-from artsci2019.lib.image_storage import read_recognized_frames, write_image
+from artsci2019.lib.portrait import finish_portrait, TriangulationCache, AlignmentPool, PortraitWindow, \
+    PortraitAccumulator
+from artsci2019.lib.image_storage import iter_recognized_frames, list_recognized_frame_files, write_image, \
+    read_landmarks
 import logging
 import cv2
+import numpy as np
 import os
 import subprocess
+import tempfile
+import time
+from collections import deque
 
 
 logger = logging.getLogger(__name__)
 
 
-def gen_portraits(rfs, stack_size, pool_size, loop, stable_points):
+def frames_in_flight(stack_size, pool_size):
+    """How many output frames to keep in flight, so that there are
+    always enough faces queued to keep every worker busy."""
+    return -(-pool_size // stack_size) + 1
+
+
+def _looped(rfs, stack_size):
+    """Yields the frames, followed by the first stack_size - 1 frames again."""
+    head = []
+    for rf in rfs:
+        if len(head) < stack_size - 1:
+            head.append(rf)
+        yield rf
+    for rf in head:
+        yield rf
+
+
+def iter_portraits(rfs, stack_size, pool_size, loop, stable_points, alignment_pool):
+    """Takes an iterable of recognized frames and lazily yields a portrait
+    for every window of stack_size consecutive frames, see gen_portraits.
+    Only the frames of the current window and of the frames in flight are
+    kept in memory."""
+    if loop:
+        rfs = _looped(rfs, stack_size)
+    max_in_flight = frames_in_flight(stack_size, pool_size)
+    logger.info("Generating frames.  Frames in flight: {}.".format(max_in_flight))
+    # every image is part of stack_size windows, only triangulate it once
+    triangulation_cache = TriangulationCache(stack_size)
+    window = PortraitWindow(stack_size)
+    in_flight = deque()
+    generated = 0
+    try:
+        for rf in rfs:
+            window.push(rf)
+            if not window.is_full():
+                continue
+            in_flight.append(window.submit(stable_points, alignment_pool, triangulation_cache))
+            # jobs finish in submission order, so the frames stay in order
+            if len(in_flight) >= max_in_flight:
+                generated += 1
+                logger.info("Generated frame {}.".format(generated))
+                yield finish_portrait(in_flight.popleft())
+        while in_flight:
+            generated += 1
+            logger.info("Generated frame {}.".format(generated))
+            yield finish_portrait(in_flight.popleft())
+    finally:
+        for job in in_flight:
+            job.release()
+    logger.info("Triangulations computed: {}, reused: {}.".format(triangulation_cache.misses,
+                                                                  triangulation_cache.hits))
+
+
+def gen_portraits(rfs, stack_size, pool_size, loop, stable_points, alignment_pool=None):
     """Takes a sequence of recognized frames,
     the stack size (how many pictures to stack per portrait),
     the pool size (how many threads to use),
-    and if the video should loop or not."""
-    if loop:
-        rfs = rfs + rfs[:stack_size - 1]
-    frame_count = len(rfs) - stack_size
-    logger.info("Generating frames.  Frames to generate: {}.".format(frame_count))
-    frames = []
-    for i in range(frame_count):
-        logger.info("Generating frame {}/{}.".format(i + 1, frame_count))
-        portrait = gen_portrait(rfs[i:i + stack_size], pool_size, stable_points)
-        frames.append(portrait)
-    return frames
+    and if the video should loop or not.
+    Optionally an AlignmentPool to use instead of a new one.
+    Several output frames are rendered at once, the faces of all of them
+    are spread over the whole pool."""
+    if alignment_pool is None:
+        with AlignmentPool(pool_size) as p:
+            return gen_portraits(rfs, stack_size, pool_size, loop, stable_points, p)
+    return list(iter_portraits(rfs, stack_size, pool_size, loop, stable_points, alignment_pool))
+
+
+def write_intermediate_file(portrait, output_dir, i):
+    path = os.path.join(output_dir, "{:06d}.png".format(i))
+    logger.debug("Writing portrait {} to {}".format(i, path))
+    cv2.imwrite(path, portrait)
 
 
 def write_intermediate_files(portraits, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     for i, p in enumerate(portraits):
-        path = os.path.join(output_dir, "{:06d}.png".format(i))
-        logger.debug("Writing portrait {} to {}".format(i, path))
-        cv2.imwrite(path, p)
+        write_intermediate_file(p, output_dir, i)
 
 
 def generate_video(input_dir, output_file):
@@ -44,23 +104,221 @@ def generate_video(input_dir, output_file):
     ])
 
 
+class VideoWriter:
+    """Streams raw BGR frames into an ffmpeg process over stdin.
+    The process is started with the size of the first frame.  If ffmpeg
+    fails, an error with the end of its output is raised."""
+
+    def __init__(self, output_file, framerate=10):
+        self.output_file = output_file
+        self.framerate = framerate
+        self.process = None
+        self.args = None
+        self.log = None
+
+    def write(self, frame):
+        if self.process is None:
+            f_h, f_w, _ = frame.shape
+            self.args = [
+                'ffmpeg',
+                '-y',  # cannot ask before overwriting, stdin is taken by the frames
+                '-loglevel', 'error',
+                '-f', 'rawvideo',
+                '-pix_fmt', 'bgr24',
+                '-s', '{}x{}'.format(f_w, f_h),
+                '-r', str(self.framerate),
+                '-i', '-',
+                self.output_file
+            ]
+            self.log = tempfile.TemporaryFile()
+            self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stderr=self.log)
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited, its output tells why
+            self.close()
+            raise IOError("ffmpeg stopped reading frames for {}".format(self.output_file))
+
+    def _check(self, returncode):
+        if returncode != 0:
+            self.log.seek(0)
+            output = self.log.read().decode(errors="replace").strip()
+            logger.error("ffmpeg failed with exit code {} writing {}:\n{}".format(returncode, self.output_file, output))
+            raise subprocess.CalledProcessError(returncode, self.args, stderr=output)
+
+    def close(self):
+        """Waits for ffmpeg to finish.  Raises a CalledProcessError with the
+        output of ffmpeg if it failed."""
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        try:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._check(process.wait())
+        finally:
+            self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # do not hide the error that ended the writing
+        try:
+            self.close()
+        except (subprocess.CalledProcessError, OSError):
+            logger.exception("ffmpeg failed as well.")
+
+
 def run_genanimation(input_dir, intermediate_dir, output_file, stack_size, pool_size, loop, stable_points):
+    """Streams the portraits straight into ffmpeg.  The portraits are
+    only written to intermediate_dir as well if it is given."""
     logger.info("Reading frames from {} ...".format(input_dir))
-    rfs = read_recognized_frames(input_dir)
-    logger.info("Generating portraits ...")
-    portraits = gen_portraits(rfs, stack_size, pool_size, loop, stable_points)
-    logger.info("Writing portraits ...")
-    write_intermediate_files(portraits, intermediate_dir)
+    image_count = len(list_recognized_frame_files(input_dir))
+    logger.info("Images found: {}.".format(image_count))
+    rfs = iter_recognized_frames(input_dir)
+    if not output_file:
+        output_file = input_dir + ".gif"
+    if intermediate_dir and not os.path.exists(intermediate_dir):
+        os.makedirs(intermediate_dir)
     logger.info("Generating video ...")
-    generate_video(intermediate_dir, output_file)
+    with AlignmentPool(pool_size) as alignment_pool, VideoWriter(output_file) as video:
+        portraits = iter_portraits(rfs, stack_size, pool_size, loop, stable_points, alignment_pool)
+        for i, portrait in enumerate(portraits):
+            video.write(portrait)
+            if intermediate_dir:
+                write_intermediate_file(portrait, intermediate_dir, i)
+    logger.info("Done.")
+
+
+def list_landmarks(input_dir):
+    """Returns the image files of the directory and an array with their
+    landmarks, read from the landmark manifest without loading any image."""
+    names, landmarks = read_landmarks(input_dir)
+    image_files = {os.path.splitext(os.path.basename(f))[0]: f for f in list_recognized_frame_files(input_dir)}
+    found = [i for i, name in enumerate(names) if name in image_files]
+    if len(found) < len(names):
+        logger.warning("{} images listed in the manifest are missing.".format(len(names) - len(found)))
+    return [image_files[names[i]] for i in found], landmarks[found]
+
+
+def save_checkpoint(checkpoint_file, total, count, target_landmarks, stable_points, processed):
+    """Writes the state of a portrait merge: the sum of the aligned images,
+    their count, the target landmarks, the stable points and the names of
+    the processed images.  The file is replaced atomically."""
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(f,
+                 total=total,
+                 count=count,
+                 target_landmarks=target_landmarks,
+                 stable_points=np.array(stable_points, dtype=np.int32).reshape(-1, 2),
+                 processed=np.array(sorted(processed), dtype=str))
+    os.replace(tmp_file, checkpoint_file)
+
+
+def load_checkpoint(checkpoint_file):
+    """Returns the state written by save_checkpoint as a dict, None if there is no checkpoint."""
+    if not os.path.exists(checkpoint_file):
+        return None
+    with np.load(checkpoint_file) as data:
+        return {
+            "total": data["total"],
+            "count": int(data["count"]),
+            "target_landmarks": data["target_landmarks"],
+            "stable_points": [tuple(p) for p in data["stable_points"].tolist()],
+            "processed": set(data["processed"].tolist()),
+        }
+
+
+def _image_name(image_file):
+    return os.path.splitext(os.path.basename(image_file))[0]
+
+
+def _resume(checkpoint, target_landmarks, stable_points, frame_shape, pin_targets):
+    """Returns whether the merge can continue from the checkpoint."""
+    if checkpoint["total"].shape != tuple(frame_shape):
+        logger.warning("The checkpoint is for images of a different size, starting over.")
+        return False
+    if checkpoint["stable_points"] != [tuple(p) for p in stable_points]:
+        logger.warning("The checkpoint used different stable points, starting over.")
+        return False
+    if not pin_targets and not np.array_equal(checkpoint["target_landmarks"], target_landmarks):
+        logger.warning("Images were added since the checkpoint, so the target landmarks changed; starting over. "
+                       "Pin the target landmarks to only merge in the new images.")
+        return False
+    return True
+
+
+def _frame_shape(image_files):
+    """The shape of the first image that can be read, unreadable images are skipped later on."""
+    for image_file in image_files:
+        frame = cv2.imread(image_file)
+        if frame is not None:
+            return frame.shape
+        logger.warning("Could not read {}.".format(image_file))
+    raise ValueError("None of the images could be read.")
+
+
+def stream_portrait(input_dir, pool_size, stable_points, batch_size=None, checkpoint_file=None,
+                    checkpoint_interval=60, pin_targets=False):
+    """Merges all images of the directory into one portrait in two passes.
+    The target landmarks are the mean of the landmarks from the manifest,
+    then the images are streamed through the workers of a
+    PortraitAccumulator.  Only about pool_size images are in memory at once.
+    With a checkpoint_file, the progress is saved every checkpoint_interval
+    seconds and a later run continues where it stopped.  With pin_targets,
+    the target landmarks of the checkpoint are kept, so images added since
+    are merged in without starting over."""
+    image_files, landmarks = list_landmarks(input_dir)
+    if not image_files:
+        raise ValueError("No images in {}".format(input_dir))
+    target_landmarks = landmarks.mean(axis=0).astype(np.int32)
+    frame_shape = _frame_shape(image_files)
+    batch_size = batch_size or 16 * pool_size
+    processed = set()
+    with PortraitAccumulator(pool_size, frame_shape) as accumulator:
+        checkpoint = load_checkpoint(checkpoint_file) if checkpoint_file else None
+        if checkpoint is not None and _resume(checkpoint, target_landmarks, stable_points, frame_shape, pin_targets):
+            target_landmarks = checkpoint["target_landmarks"]
+            processed = checkpoint["processed"]
+            accumulator.load(checkpoint["total"], checkpoint["count"])
+            logger.info("Continuing from the checkpoint with {} merged images.".format(accumulator.count))
+        todo = [i for i, image_file in enumerate(image_files) if _image_name(image_file) not in processed]
+        logger.info("Images: {}, to merge: {}.".format(len(image_files), len(todo)))
+
+        def checkpoint_now():
+            save_checkpoint(checkpoint_file, accumulator.reduce(), accumulator.count, target_landmarks,
+                            stable_points, processed)
+
+        checkpoint_time = time.time() + checkpoint_interval
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            batch_files = [image_files[i] for i in batch]
+            skipped = accumulator.add(batch_files, landmarks[batch], target_landmarks, stable_points)
+            for image_file in skipped:
+                logger.warning("Skipped {}, it could not be read or has a different size.".format(image_file))
+            # skipped images are not retried either
+            processed.update(_image_name(f) for f in batch_files)
+            logger.info("Merged {}/{} images.".format(min(start + batch_size, len(todo)), len(todo)))
+            if checkpoint_file and time.time() > checkpoint_time:
+                checkpoint_now()
+                checkpoint_time = time.time() + checkpoint_interval
+        if checkpoint_file and todo:
+            checkpoint_now()
+        return accumulator.portrait()
 
 
-def run_portrait(input_dir, pool_size, output_file, stable_points):
-    logger.info("Reading frames ...")
-    rfs = read_recognized_frames(input_dir)
-    # rfs = [rf.cropped(1080, 1773 - 333, 0, 333) for rf in rfs]
+def run_portrait(input_dir, pool_size, output_file, stable_points, checkpoint_file=None, pin_targets=False,
+                 checkpoint_interval=60):
     logger.info("Generating Portrait ...")
-    f = gen_portrait(rfs, pool_size, stable_points)
+    f = stream_portrait(input_dir, pool_size, stable_points, checkpoint_file=checkpoint_file,
+                        checkpoint_interval=checkpoint_interval, pin_targets=pin_targets)
     logger.info("Writing output file ...")
     if not output_file:
         output_file = input_dir + ".png"
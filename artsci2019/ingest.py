@@ -0,0 +1,114 @@
+from artsci2019.lib.face_recog import get_faces
+from artsci2019.lib.frame_checker import FrameChecker
+from artsci2019.lib.image_storage import write_recognized_frame, ensure_manifest, IMAGE_FORMATS
+from multiprocessing import Pool
+import datetime
+import hashlib
+import logging
+import time
+import cv2
+import os
+
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILENAME = ".ingest_progress"
+PHOTO_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def list_photos(input_dir):
+    """Returns the sorted paths of all photos below the directory."""
+    photos = []
+    for root, _, files in os.walk(input_dir):
+        for f in files:
+            if f.lower().endswith(PHOTO_EXTENSIONS):
+                photos.append(os.path.abspath(os.path.join(root, f)))
+    photos.sort()
+    return photos
+
+
+def read_progress(target_dir):
+    """Returns the set of photos that were already ingested into the directory."""
+    path = os.path.join(target_dir, PROGRESS_FILENAME)
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as f:
+        return set(line.rstrip("\n") for line in f if line.strip())
+
+
+def frame_name(path, date, index):
+    """The name of a face found in a photo: the date, so the images sort in
+    the order they were taken, a hash of the photo path and the face index.
+    The same face of the same photo always gets the same name."""
+    path_hash = hashlib.sha1(path.encode()).hexdigest()[:8]
+    return "{}-{}-{}".format(date.strftime("%Y-%m-%d-%H-%M-%S-%f"), path_hash, index)
+
+
+def _ingest_photo(args):
+    """Helper function for parallelization.  Finds the faces in one photo
+    and writes the ones that pass the quality filter.
+    Returns (path, faces found, faces written, error)."""
+    path, target_dir, scaling_factor, quality_filter, image_format, compression = args
+    try:
+        frame = cv2.imread(path)
+        if frame is None:
+            return path, 0, 0, "could not read the image"
+        rfs = get_faces(frame, scaling_factor)
+        found = len(rfs)
+        if quality_filter:
+            f_h, f_w, _ = frame.shape
+            frame_checker = FrameChecker(f_w, f_h)
+            rfs = [rf for rf in rfs if frame_checker.check(rf).all_ok]
+        # name the frames after the time the photo was taken
+        date = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        for i, rf in enumerate(rfs):
+            # faces written before an interrupted run are written again under the same name
+            write_recognized_frame(target_dir, rf, image_format, compression, date=date,
+                                   name=frame_name(path, date, i))
+        return path, found, len(rfs), None
+    except Exception as e:
+        return path, 0, 0, repr(e)
+
+
+def run_ingest(input_dir, target_dir, pool_size, quality_filter, image_format="png", compression=None,
+               scaling_factor=4, report_interval=10):
+    """Finds the faces in all photos below input_dir and writes them to the
+    image store in target_dir, like the display does.  Photos that were
+    ingested before are skipped, so an interrupted run can be resumed."""
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("Unknown image format: {}".format(image_format))
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    ensure_manifest(target_dir)
+    photos = list_photos(input_dir)
+    done = read_progress(target_dir)
+    todo = [p for p in photos if p not in done]
+    logger.info("Photos found: {}, already ingested: {}, to ingest: {}.".format(
+        len(photos), len(photos) - len(todo), len(todo)))
+    if not todo:
+        return
+
+    tasks = [(p, target_dir, scaling_factor, quality_filter, image_format, compression) for p in todo]
+    processed = found = written = failed = 0
+    start_time = time.time()
+    report_time = start_time + report_interval
+    with Pool(pool_size) as pool, open(os.path.join(target_dir, PROGRESS_FILENAME), "a") as progress:
+        for path, faces, kept, error in pool.imap_unordered(_ingest_photo, tasks):
+            processed += 1
+            if error is not None:
+                failed += 1
+                logger.warning("Ingesting {} failed: {}".format(path, error))
+            else:
+                found += faces
+                written += kept
+                # only mark the photo as done once its frames are written
+                progress.write(path + "\n")
+                progress.flush()
+            now = time.time()
+            if now > report_time or processed == len(todo):
+                rate = processed / (now - start_time)
+                eta = (len(todo) - processed) / rate if rate > 0 else 0
+                logger.info("Ingested {}/{} photos ({:.1f} photos/s, ETA {:.0f} s), "
+                            "faces found: {}, written: {}, failed photos: {}.".format(
+                                processed, len(todo), rate, eta, found, written, failed))
+                report_time = now + report_interval
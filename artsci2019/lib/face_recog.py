@@ -1,34 +1,40 @@
 import face_recognition
 import cv2
-from artsci2019.lib.util import scale_face_landmarkss, RecognizedFrame
+import numpy as np
+from artsci2019.lib.util import scale_face_landmarkss, crop_face_landmarks, landmark_array, RecognizedFrame
+from artsci2019.lib.metrics import timed
 
 
-def _face_landmarks_to_list(face_landmarks):
-    """Takes a dict of the face landmarks and turns it into a single list
-    of tuples."""
+def _face_landmarks_to_array(face_landmarks):
+    """Takes a dict of the face landmarks and turns it into a single int32
+    array of shape (n, 2)."""
     res = []
     for area in ['chin', 'left_eyebrow', 'right_eyebrow', 'nose_bridge', 'nose_tip',
                  'left_eye', 'right_eye', 'top_lip', 'bottom_lip']:
-        for lm in face_landmarks[area]:
-            res.append(lm)
-    return res
+        res.extend(face_landmarks[area])
+    return landmark_array(res)
 
 
-def get_faces(frame, scaling_factor):
-    """Takes a frame, recognizes the faces and returns a list of
-    RecognizedFrame, one for each face.  Can return an empty list."""
+def _detect_landmarks(frame, scaling_factor):
+    """Returns a list of landmark lists, one per face found in the frame."""
     # Resize frame of video for faster face recognition processing
     small_frame = cv2.resize(frame, (0, 0), fx=1/scaling_factor, fy=1/scaling_factor)
 
     # Convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
     rgb_small_frame = small_frame[:, :, ::-1]
 
-    # Only process every other frame of video to save time
     # Find all the faces and face encodings in the current frame of video
-    face_landmarkss = face_recognition.face_landmarks(rgb_small_frame)
-    face_landmarkss = [_face_landmarks_to_list(flms) for flms in face_landmarkss]
+    with timed("detect"):
+        face_landmarkss = face_recognition.face_landmarks(rgb_small_frame)
+    face_landmarkss = [_face_landmarks_to_array(flms) for flms in face_landmarkss]
     # Scale them back up
-    face_landmarkss = scale_face_landmarkss(face_landmarkss, scaling_factor)
+    return scale_face_landmarkss(face_landmarkss, scaling_factor)
+
+
+def get_faces(frame, scaling_factor):
+    """Takes a frame, recognizes the faces and returns a list of
+    RecognizedFrame, one for each face.  Can return an empty list."""
+    face_landmarkss = _detect_landmarks(frame, scaling_factor)
 
     r_frames = []
 
@@ -40,4 +46,77 @@ def get_faces(frame, scaling_factor):
     return r_frames
 
 
+def landmarks_roi(face_landmarkss, frame_w, frame_h, margin):
+    """Returns the box (x0, y0, x1, y1) around all the landmarks, grown by
+    margin times its size on every side and clipped to the frame."""
+    points = np.concatenate(face_landmarkss)
+    x0, y0 = points.min(axis=0)
+    x1, y1 = points.max(axis=0)
+    m_x = int((x1 - x0) * margin)
+    m_y = int((y1 - y0) * margin)
+    return (max(int(x0) - m_x, 0),
+            max(int(y0) - m_y, 0),
+            min(int(x1) + m_x, frame_w),
+            min(int(y1) + m_y, frame_h))
+
+
+class FaceTracker:
+    """Finds faces like get_faces, but while faces are tracked only the
+    region around their last landmarks is searched.  The whole frame is
+    searched again if a face is lost, and on a schedule to find new faces.
+    The schedule stretches from min_interval up to max_interval frames
+    while the tracking holds, and is reset when a face is lost."""
+
+    def __init__(self, scaling_factor, margin=0.6, min_interval=2, max_interval=16):
+        self.scaling_factor = scaling_factor
+        self.margin = margin
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.frames_since_full = 0
+        self.last_landmarkss = []
+        self.full_detections = 0
+        self.roi_detections = 0
+        self.lost = 0
+
+    def _track(self, frame):
+        """Searches the region of interest, returns None if a face was lost."""
+        f_h, f_w, _ = frame.shape
+        x0, y0, x1, y1 = landmarks_roi(self.last_landmarkss, f_w, f_h, self.margin)
+        found = _detect_landmarks(frame[y0:y1, x0:x1], self.scaling_factor)
+        if len(found) < len(self.last_landmarkss):
+            self.lost += 1
+            self.interval = self.min_interval
+            return None
+        self.roi_detections += 1
+        return [crop_face_landmarks(flms, -x0, -y0) for flms in found]
+
+    @property
+    def tracking(self):
+        """Whether faces from the last frame are being followed."""
+        return bool(self.last_landmarkss)
+
+    def get_faces(self, frame):
+        face_landmarkss = None
+        if self.last_landmarkss:
+            if self.frames_since_full < self.interval:
+                face_landmarkss = self._track(frame)
+            else:
+                # the tracking held for the whole interval
+                self.interval = min(self.interval * 2, self.max_interval)
+        if face_landmarkss is None:
+            face_landmarkss = _detect_landmarks(frame, self.scaling_factor)
+            self.full_detections += 1
+            self.frames_since_full = 0
+        else:
+            self.frames_since_full += 1
+        self.last_landmarkss = face_landmarkss
+        return [RecognizedFrame(frame, flms) for flms in face_landmarkss]
 
+    def stats(self):
+        return {
+            "full_detections": self.full_detections,
+            "roi_detections": self.roi_detections,
+            "lost": self.lost,
+            "interval": self.interval,
+        }
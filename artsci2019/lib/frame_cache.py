@@ -0,0 +1,107 @@
+import cv2
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_THREADS = 4
+DEFAULT_READ_AHEAD = 8
+
+
+class FrameCache:
+    """An LRU cache of decoded images, bounded by the number of bytes of
+    the decoded frames.  Images are decoded on a pool of threads, so
+    frames that are asked for ahead of time are decoded in parallel."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, threads=DEFAULT_THREADS, read_ahead=DEFAULT_READ_AHEAD):
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.read_ahead = read_ahead
+        self.lock = threading.Lock()
+        self.frames = OrderedDict()  # path -> frame
+        self.pending = {}  # path -> Future
+        self.size = 0
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def _decode(self, path):
+        frame = cv2.imread(path)
+        if frame is None:
+            raise IOError("Could not read image {}".format(path))
+        return frame
+
+    def _load(self, path):
+        try:
+            frame = self._decode(path)
+        except Exception:
+            with self.lock:
+                self.pending.pop(path, None)
+            raise
+        with self.lock:
+            self.pending.pop(path, None)
+            self._put(path, frame)
+        return frame
+
+    def _put(self, path, frame):
+        if frame.nbytes > self.max_bytes or path in self.frames:
+            return
+        self.frames[path] = frame
+        self.size += frame.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.frames.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def _submit(self, path):
+        """Needs to be called with the lock held."""
+        future = self.pending.get(path)
+        if future is None:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.threads)
+            future = self.executor.submit(self._load, path)
+            self.pending[path] = future
+        return future
+
+    def get(self, path):
+        """Returns the decoded image, decoding it if it is not cached."""
+        with self.lock:
+            frame = self.frames.get(path)
+            if frame is not None:
+                self.hits += 1
+                self.frames.move_to_end(path)
+                return frame
+            self.misses += 1
+            future = self._submit(path)
+        return future.result()
+
+    def prefetch(self, paths):
+        """Starts decoding the images in the background."""
+        with self.lock:
+            for path in paths:
+                if path not in self.frames:
+                    self._submit(path)
+
+    def clear(self):
+        with self.lock:
+            self.frames = OrderedDict()
+            self.size = 0
+
+
+_frame_cache = FrameCache()
+
+
+def get_frame_cache():
+    return _frame_cache
+
+
+def configure_frame_cache(max_bytes=DEFAULT_MAX_BYTES, threads=DEFAULT_THREADS, read_ahead=DEFAULT_READ_AHEAD):
+    """Replaces the cache shared by all lazily loaded frames of this process."""
+    global _frame_cache
+    logger.info("Frame cache: {} MB, {} threads, read ahead {}.".format(max_bytes // (1024 * 1024),
+                                                                       threads, read_ahead))
+    _frame_cache = FrameCache(max_bytes, threads, read_ahead)
+    return _frame_cache
@@ -1,4 +1,5 @@
 import numpy as np
+from artsci2019.lib.metrics import timed
 
 
 class FrameChecker:
@@ -12,13 +13,14 @@ class FrameChecker:
         self.threshold = 0.5
 
     def check(self, recognized_frame):
-        return CheckedFrame(self.line_width,
-                            self.line_width_margin,
-                            self.centre,
-                            self.centre_margin,
-                            self.max_height,
-                            self.threshold,
-                            recognized_frame)
+        with timed("check"):
+            return CheckedFrame(self.line_width,
+                                self.line_width_margin,
+                                self.centre,
+                                self.centre_margin,
+                                self.max_height,
+                                self.threshold,
+                                recognized_frame)
 
 
 class CheckedFrame:
@@ -1,9 +1,16 @@
 import cv2
+import numpy as np
 import datetime
 import os
 import json
 import logging
+import queue
+import threading
+from collections import deque
 from artsci2019.lib.util import RecognizedFrame
+from artsci2019.lib.frame_cache import get_frame_cache
+from artsci2019.lib import landmark_manifest
+from artsci2019.lib.metrics import timed
 
 
 logger = logging.getLogger(__name__)
@@ -13,39 +20,218 @@ def write_image(frame, filename):
     cv2.imwrite(filename, frame)
 
 
-def write_recognized_frame(dir, rf):
-    current_date = datetime.datetime.now()
+# image format -> (file extension, imwrite flag of the compression parameter)
+IMAGE_FORMATS = {
+    "png": (".png", cv2.IMWRITE_PNG_COMPRESSION),  # 0 - 9, higher is smaller and slower
+    "jpg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),  # 0 - 100, higher is better
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),  # 1 - 100, higher is better
+}
+IMAGE_EXTENSIONS = tuple(ext for ext, _ in IMAGE_FORMATS.values())
+
+
+def _write_file(filename, data, sync):
+    """Writes to a temporary file that is renamed when complete, so the
+    file is never seen half written."""
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def write_recognized_frame(dir, rf, image_format="png", compression=None, date=None, sync=False, name=None):
+    """Writes the image and its landmarks to the directory, named by the date
+    unless a name is given.  Writing the same name again replaces the files.
+    The compression is the quality or compression level of the image format,
+    None for the OpenCV default.  With sync the files are flushed to disk.
+    The json file is written before the image, so every image has one."""
+    current_date = date if date is not None else datetime.datetime.now()
     date_str = current_date.strftime("%Y-%m-%d-%H-%M-%S-%f")
-    img_filename = os.path.join(dir, date_str + ".png")
-    cv2.imwrite(img_filename, rf.frame)
-    json_filename = os.path.join(dir, date_str + ".json")
-    info = {
-        "date": date_str,
-        "landmarks": rf.face_landmarks
-    }
-    with open(json_filename, "w") as f:
-        json.dump(info, f)
-
-
-def write_recognized_frames(target_dir, rfs):
+    name = name if name is not None else date_str
+    # fail before any file is written
+    landmark_manifest.check_name(name)
+    ext, compression_flag = IMAGE_FORMATS[image_format]
+    params = [compression_flag, compression] if compression is not None else []
+    with timed("encode"):
+        ok, data = cv2.imencode(ext, rf.frame, params)
+    if not ok:
+        raise IOError("Could not encode the image as {}".format(image_format))
+    with timed("write"):
+        json_filename = os.path.join(dir, name + ".json")
+        info = {
+            "date": date_str,
+            "landmarks": rf.face_landmarks.tolist()
+        }
+        _write_file(json_filename, json.dumps(info).encode(), sync)
+        img_filename = os.path.join(dir, name + ext)
+        _write_file(img_filename, data.tobytes(), sync)
+        ensure_manifest(dir, exclude=name)
+        landmark_manifest.append_record(dir, date_str, name, rf.face_landmarks)
+
+
+def write_recognized_frames(target_dir, rfs, image_format="png", compression=None):
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
     logger.info("Writing recognized frames.")
     for rf in rfs:
-        write_recognized_frame(target_dir, rf)
+        write_recognized_frame(target_dir, rf, image_format, compression)
 
 
-def read_recognized_frames(source_directory):
-    rfs = []
+class FrameWriter:
+    """Writes recognized frames to a directory on a long lived background
+    thread, so the caller does not wait for the encoding.  The queue is
+    bounded, put blocks while it is full.  Every queued frame is written
+    and synced to disk before close returns."""
+
+    def __init__(self, target_dir, image_format="png", compression=None, max_queued=16):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError("Unknown image format: {}".format(image_format))
+        self.target_dir = target_dir
+        self.image_format = image_format
+        self.compression = compression
+        self.queue = queue.Queue(max_queued)
+        self.thread = None
+        self.written = 0
+        self.failed = 0
+
+    def put(self, recognized_frames):
+        """Queues the frames for writing, stamped with the current time."""
+        if self.thread is None:
+            if not os.path.exists(self.target_dir):
+                os.makedirs(self.target_dir)
+            self.thread = threading.Thread(target=self._run, name="FrameWriter", daemon=True)
+            self.thread.start()
+        now = datetime.datetime.now()
+        for i, rf in enumerate(recognized_frames):
+            # several faces of one capture still need distinct names
+            self.queue.put((rf, now + datetime.timedelta(microseconds=i)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                rf, date = item
+                write_recognized_frame(self.target_dir, rf, self.image_format, self.compression,
+                                       date=date, sync=True)
+                self.written += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Writing a recognized frame failed.")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Writes out everything queued and stops the thread."""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        logger.info("Frame writer closed, frames written: {}, failed: {}.".format(self.written, self.failed))
+
+
+def list_recognized_frame_files(source_directory):
+    """Returns the sorted paths of the images in the directory."""
     img_files = [source_directory + "/" + f
                  for f in os.listdir(source_directory)
-                 if f.endswith(".png")]
+                 if f.endswith(IMAGE_EXTENSIONS)]
     img_files.sort()
-    for img_file in img_files:
-        img = cv2.imread(img_file)
-        json_file = img_file[:-4] + ".json"
-        with open(json_file, "r") as f:
+    return img_files
+
+
+def read_recognized_frame(img_file):
+    """Reads the landmarks, the image itself is only loaded when it is used."""
+    json_file = os.path.splitext(img_file)[0] + ".json"
+    with open(json_file, "r") as f:
+        jdir = json.load(f)
+    return RecognizedFrame(None, jdir["landmarks"], image_file=img_file)
+
+
+def iter_recognized_frames(source_directory):
+    """Reads the recognized frames one by one, only when they are needed.
+    The next images are decoded in the background."""
+    rfs = (read_recognized_frame(img_file)
+           for img_file in list_recognized_frame_files(source_directory))
+    read_ahead = get_frame_cache().read_ahead
+    window = deque()
+    for rf in rfs:
+        rf.prefetch()
+        window.append(rf)
+        if len(window) > read_ahead:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+
+def read_recognized_frames(source_directory):
+    """Returns lazily loaded recognized frames for all images in the directory."""
+    return [read_recognized_frame(img_file)
+            for img_file in list_recognized_frame_files(source_directory)]
+
+
+def _read_sidecar_entries(source_directory):
+    """Reads (date, name, landmarks) from the json file of every image."""
+    entries = []
+    for img_file in list_recognized_frame_files(source_directory):
+        stem = os.path.splitext(img_file)[0]
+        with open(stem + ".json", "r") as f:
             jdir = json.load(f)
-        rf = RecognizedFrame(img, [tuple(lm) for lm in jdir["landmarks"]])
-        rfs.append(rf)
-    return rfs
+        name = os.path.basename(stem)
+        entries.append((jdir.get("date", name), name, jdir["landmarks"]))
+    return entries
+
+
+def rebuild_manifest(source_directory):
+    """Writes the landmark manifest of the directory from the json files.
+    Used to migrate directories from before the manifest existed."""
+    entries = _read_sidecar_entries(source_directory)
+    landmark_manifest.write_records(source_directory, landmark_manifest.build_records(entries))
+    logger.info("Manifest of {} rebuilt with {} images.".format(source_directory, len(entries)))
+
+
+def ensure_manifest(source_directory, exclude=None):
+    """Creates the manifest of a directory that has none.  If there are
+    images already, they are listed from their json files, so the manifest
+    does not start out with only the new images.  The image named exclude
+    is left out, it is about to be appended."""
+    if os.path.exists(landmark_manifest.manifest_path(source_directory)):
+        return
+    entries = [e for e in _read_sidecar_entries(source_directory) if e[1] != exclude]
+    if entries:
+        logger.info("Creating the manifest of {} with {} existing images.".format(source_directory, len(entries)))
+        landmark_manifest.write_records(source_directory, landmark_manifest.build_records(entries))
+    else:
+        landmark_manifest.ensure_manifest(source_directory)
+
+
+def read_landmarks(source_directory):
+    """Returns the image names and an array of shape (n, 72, 2) with the
+    landmarks of all images in the directory, sorted by name like the images.
+    The landmarks are read from the manifest in one go, the json files are
+    only read if there is none or it does not list exactly the images.
+    An image that was written again is listed with its last record."""
+    records = landmark_manifest.read_records(source_directory)
+    if records is None:
+        logger.warning("No landmark manifest in {}, reading the json files.".format(source_directory))
+        records = landmark_manifest.build_records(_read_sidecar_entries(source_directory))
+    else:
+        image_names = sorted(os.path.splitext(os.path.basename(f))[0]
+                             for f in list_recognized_frame_files(source_directory))
+        if image_names != sorted(set(n.decode() for n in records["name"])):
+            logger.warning("The manifest of {} lists {} of {} images, reading the json files. "
+                           "Consider rebuilding it.".format(source_directory, len(records), len(image_names)))
+            records = landmark_manifest.build_records(_read_sidecar_entries(source_directory))
+    # the index of the last record of every name, in the order of the names
+    _, last = np.unique(records["name"][::-1], return_index=True)
+    order = len(records) - 1 - last
+    names = [n.decode() for n in records["name"][order]]
+    return names, records["landmarks"][order]
@@ -0,0 +1,118 @@
+import os
+import logging
+import tempfile
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "landmarks.manifest"
+MAGIC = b"FOTCLM01"
+HEADER_SIZE = 16
+# face_recognition gives 72 points, the lip outlines share some of them
+LANDMARK_COUNT = 72
+RECORD_DTYPE = np.dtype([
+    ("date", "S32"),
+    ("name", "S64"),  # the file name of the image without extension
+    ("landmarks", "<i4", (LANDMARK_COUNT, 2))
+])
+
+
+def manifest_path(directory):
+    return os.path.join(directory, MANIFEST_FILENAME)
+
+
+def _encode_field(field, value):
+    """Encodes a text field, raises a ValueError if it does not fit, numpy would cut it off."""
+    data = value.encode()
+    size = RECORD_DTYPE[field].itemsize
+    if len(data) > size:
+        raise ValueError("The {} {} is longer than {} bytes.".format(field, value, size))
+    return data
+
+
+def check_name(name):
+    """Raises a ValueError if the image name does not fit into a record."""
+    _encode_field("name", name)
+
+
+def _record(date, name, face_landmarks):
+    record = np.zeros(1, dtype=RECORD_DTYPE)
+    record["date"] = _encode_field("date", date)
+    record["name"] = _encode_field("name", name)
+    record["landmarks"] = np.array(face_landmarks, dtype=np.int32)
+    return record
+
+
+def _write_header(f):
+    f.write(MAGIC.ljust(HEADER_SIZE, b"\0"))
+
+
+def ensure_manifest(directory):
+    """Creates an empty manifest if the directory has none.  Needed before
+    several processes append to a new directory at once."""
+    with open(manifest_path(directory), "ab") as f:
+        if f.tell() == 0:
+            _write_header(f)
+
+
+def append_record(directory, date, name, face_landmarks):
+    """Appends the landmarks of one image to the manifest of the directory.
+    The record is written with a single write, so a crash can at most
+    leave a partial last record.  Readers ignore it and the next append
+    cuts it off, so it cannot shift the records after it."""
+    path = manifest_path(directory)
+    record = _record(date, name, face_landmarks)
+    with open(path, "ab") as f:
+        size = f.tell()
+        if size < HEADER_SIZE:
+            f.truncate(0)
+            _write_header(f)
+        elif (size - HEADER_SIZE) % RECORD_DTYPE.itemsize:
+            logger.warning("Cutting off a partial record at the end of {}.".format(path))
+            f.truncate(HEADER_SIZE + (size - HEADER_SIZE) // RECORD_DTYPE.itemsize * RECORD_DTYPE.itemsize)
+        f.write(record.tobytes())
+
+
+def read_records(directory):
+    """Maps the manifest into memory.  Returns a read-only structured array
+    with the fields date, name and landmarks, or None if there is no manifest."""
+    path = manifest_path(directory)
+    if not os.path.exists(path):
+        return None
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        magic = f.read(HEADER_SIZE)
+    if magic != MAGIC.ljust(HEADER_SIZE, b"\0"):
+        raise ValueError("Not a landmark manifest: {}".format(path))
+    count = (size - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+
+def write_records(directory, records):
+    """Replaces the manifest of the directory with the given records.
+    Every writer uses its own temporary file, so concurrent rebuilds do not
+    mix up their records."""
+    path = manifest_path(directory)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=MANIFEST_FILENAME, suffix=".tmp", delete=False) as f:
+        try:
+            _write_header(f)
+            f.write(np.asarray(records, dtype=RECORD_DTYPE).tobytes())
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    # the temporary file is only readable by its owner
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+
+def build_records(entries):
+    """Takes (date, name, face_landmarks) tuples and returns the records sorted by name."""
+    entries = sorted(entries, key=lambda e: e[1])
+    records = np.zeros(len(entries), dtype=RECORD_DTYPE)
+    for i, (date, name, face_landmarks) in enumerate(entries):
+        records[i] = _record(date, name, face_landmarks)[0]
+    return records
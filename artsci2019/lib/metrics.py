@@ -0,0 +1,149 @@
+"""Timing histograms of the pipeline stages.  Collecting is off by default
+and can be switched on at runtime, while it is off timing a stage costs
+little more than a function call."""
+import bisect
+import threading
+import time
+
+
+# upper bounds of the histogram buckets in seconds, the last bucket is unbounded
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, state):
+        """Adds the observations of a histogram exported by to_dict."""
+        for i, c in enumerate(state["counts"]):
+            self.counts[i] += c
+        self.count += state["count"]
+        self.sum += state["sum"]
+        self.max = max(self.max, state["max"])
+
+    def quantile(self, q):
+        """The upper bound of the bucket the q quantile falls into."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, c in zip(self.buckets, self.counts):
+            seen += c
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {"counts": list(self.counts), "count": self.count, "sum": self.sum, "max": self.max}
+
+
+class Timer:
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        if self.metrics.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """A histogram of durations per stage, safe to use from several threads."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def timed(self, stage):
+        """A context manager recording how long its block takes."""
+        return Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def merge(self, states):
+        """Adds the histograms exported by drain, e.g. in a worker process."""
+        if not self.enabled:
+            return
+        with self.lock:
+            for stage, state in states.items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram()
+                histogram.merge(state)
+
+    def drain(self):
+        """Returns the histograms as dicts and starts over."""
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+        return {stage: h.to_dict() for stage, h in histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def summary(self):
+        """Count, mean, p50, p90, p99 and max in seconds per stage."""
+        with self.lock:
+            return {stage: {"count": h.count,
+                            "mean": h.sum / h.count,
+                            "p50": h.quantile(0.5),
+                            "p90": h.quantile(0.9),
+                            "p99": h.quantile(0.99),
+                            "max": h.max}
+                    for stage, h in sorted(self.histograms.items()) if h.count}
+
+    def prometheus(self, name="fotc_stage_seconds"):
+        """The histograms in the Prometheus text format."""
+        lines = ["# TYPE {} histogram".format(name)]
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                seen = 0
+                for bound, c in zip(h.buckets, h.counts):
+                    seen += c
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, seen))
+                lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stage, h.count))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, h.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, h.count))
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def timed(stage):
+    return _metrics.timed(stage)
+
+
+def enable_metrics(enabled=True):
+    _metrics.enabled = enabled
@@ -0,0 +1,152 @@
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class LatestSlot:
+    """Holds only the most recent value put into it.  A value that is
+    replaced before it was taken counts as dropped."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.value = None
+        self.seq = 0
+        self.taken_seq = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, value, merge=None):
+        """Puts a value.  If the previous value was not taken yet and a merge
+        function is given, merge(previous, value) is put instead of dropping it."""
+        with self.cond:
+            if self.seq > self.taken_seq:
+                if merge is not None:
+                    value = merge(self.value, value)
+                else:
+                    self.dropped += 1
+            self.value = value
+            self.seq += 1
+            self.cond.notify_all()
+
+    def take(self, timeout=None):
+        """Waits for a value that was not taken yet and returns it.
+        Returns None on timeout or if the slot was closed."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > self.taken_seq or self.closed, timeout)
+            if self.seq == self.taken_seq:
+                return None
+            self.taken_seq = self.seq
+            return self.value
+
+    def peek(self):
+        """Returns the latest value and its sequence number without taking it."""
+        with self.cond:
+            return self.value, self.seq
+
+    def depth(self):
+        """The number of values waiting to be taken, 0 or 1."""
+        with self.cond:
+            return self.seq - self.taken_seq
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class CaptureThread(threading.Thread):
+    """Reads frames as fast as the source delivers them and only keeps the
+    latest one.  read_frame returns (rval, frame) like VideoCapture.read."""
+
+    def __init__(self, read_frame):
+        super().__init__(name="CaptureThread", daemon=True)
+        self.read_frame = read_frame
+        self.frames = LatestSlot()
+        self.running = True
+        self.captured = 0
+
+    def run(self):
+        while self.running:
+            rval, frame = self.read_frame()
+            if not rval:
+                logger.warning("Capturing a frame failed, stopping capture.")
+                break
+            self.captured += 1
+            self.frames.put(frame)
+        self.running = False
+        self.frames.close()
+
+    def stop(self):
+        self.running = False
+
+
+class DetectionThread(threading.Thread):
+    """Runs detect on the freshest captured frame, frames that arrive while
+    a detection is running are dropped.  The latest (frame, result) pair is
+    put into the results slot."""
+
+    def __init__(self, frames, detect):
+        super().__init__(name="DetectionThread", daemon=True)
+        self.frames = frames
+        self.detect = detect
+        self.results = LatestSlot()
+        self.running = True
+        self.detected = 0
+
+    def run(self):
+        while self.running:
+            frame = self.frames.take(timeout=0.5)
+            if frame is None:
+                if self.frames.closed:
+                    break
+                continue
+            self.results.put((frame, self.detect(frame)))
+            self.detected += 1
+        self.results.close()
+
+    def stop(self):
+        self.running = False
+
+
+class BackgroundWorker(threading.Thread):
+    """Runs work on submitted items one at a time.  An item submitted while
+    the worker is busy waits, replacing any other waiting item, or merged
+    with it if a merge function is given.  Results that are not None are
+    put into the results slot."""
+
+    def __init__(self, work, name="BackgroundWorker", merge=None):
+        super().__init__(name=name, daemon=True)
+        self.work = work
+        self.merge = merge
+        self.requests = LatestSlot()
+        self.results = LatestSlot()
+        self.running = True
+        self.busy = False
+
+    def submit(self, item):
+        self.requests.put(item, self.merge)
+
+    def run(self):
+        while self.running:
+            item = self.requests.take(timeout=0.5)
+            if item is None:
+                if self.requests.closed:
+                    break
+                continue
+            self.busy = True
+            try:
+                result = self.work(item)
+                if result is not None:
+                    self.results.put(result)
+            except Exception:
+                logger.exception("Background work failed.")
+            finally:
+                self.busy = False
+        self.results.close()
+
+    def stop(self):
+        """Stops the worker once the current item is done."""
+        self.running = False
+        self.requests.close()
@@ -1,8 +1,12 @@
 import numpy as np
 import cv2
 import logging
-from multiprocessing import Pool
-from artsci2019.lib.util import is_in_frame
+import threading
+from collections import OrderedDict, deque
+from multiprocessing import Pool, resource_tracker
+from artsci2019.lib.util import iter_read_ahead, scale_point, landmark_array, scale_face_landmarks, in_frame_mask
+from artsci2019.lib.shared_memory import SharedArray
+from artsci2019.lib.metrics import get_metrics, timed
 
 
 logger = logging.getLogger(__name__)
@@ -30,55 +34,99 @@ def draw_triangle(frame, triangle):
     cv2.line(frame, pt3, pt1, (0, 255, 0), 4, 8, 0)
 
 
-def get_delaunay_mapping(face_landmarks, targets, frame_w, frame_h, stable_points=[]):
+def get_delaunay_triangles(face_landmarks, frame_w, frame_h, stable_points=[]):
+    """Triangulates the face landmarks together with the edge points and the
+    stable points.  Returns an int32 array of shape (n, 3), each row holds the
+    indices of the triangle corners into face_landmarks + edge points + stable points.
+    The triangulation only depends on the source points, so it can be reused
+    for any set of targets."""
+    face_landmarks = landmark_array(face_landmarks)
+    fixed_points = landmark_array(generate_edge_points(frame_w, frame_h) + list(stable_points))
+    points = np.concatenate([face_landmarks, fixed_points])
+
+    rect = (0, 0, frame_w, frame_h)
+    subdiv = cv2.Subdiv2D(rect)
+    in_frame = face_landmarks[in_frame_mask(frame_w, frame_h, face_landmarks)]
+    if len(in_frame):
+        subdiv.insert(in_frame.astype(np.float32))
+    subdiv.insert(fixed_points.astype(np.float32))
+
+    # the corners come back as coordinates, look up their indices in the sorted
+    # point keys; later points win on duplicates, as the stable sort puts them last
+    corners = subdiv.getTriangleList().reshape(-1, 2).astype(np.int64)
+    points = points.astype(np.int64)
+    lowest = points.min(axis=0)
+    width = points[:, 0].max() - lowest[0] + 1
+
+    def keys(p):
+        return (p[:, 1] - lowest[1]) * width + p[:, 0] - lowest[0]
+    point_keys = keys(points)
+    order = np.argsort(point_keys, kind="stable")
+    sorted_keys = point_keys[order]
+    found = np.searchsorted(sorted_keys, keys(corners), side="right") - 1
+    assert np.all(sorted_keys[found] == keys(corners)), "Triangle corner is not one of the points."
+    return order[found].astype(np.int32).reshape(-1, 3)
+
+
+def get_delaunay_mapping(face_landmarks, targets, frame_w, frame_h, stable_points=[], triangles=None):
     """Takes a list of face landmarks and a corresponding list of targets.
     Returns a list of tuples of triangles [(src_triangle, target_triangle)].
     The frame width and heigth are used for edge points.
-    Optionally a list of stable points can be given."""
-    assert isinstance(face_landmarks, list)
-    assert isinstance(targets, list)
-    logger.debug("delaunay mapping: frame: {} {}".format(frame_w, frame_h))
-    logger.debug("delaunay mapping: face_landmarks: {}".format(face_landmarks))
-    logger.debug("delaunay mapping: targets: {}".format(targets))
+    Optionally a list of stable points can be given.
+    A triangulation from get_delaunay_triangles can be given to skip triangulating."""
+    face_landmarks = landmark_array(face_landmarks)
+    targets = landmark_array(targets)
+    # formatting the arrays is slow, only done if debug logging is on
+    logger.debug("delaunay mapping: frame: %s %s", frame_w, frame_h)
+    logger.debug("delaunay mapping: face_landmarks: %s", face_landmarks)
+    logger.debug("delaunay mapping: targets: %s", targets)
 
-    point_map = dict(zip(face_landmarks, targets))
+    if triangles is None:
+        triangles = get_delaunay_triangles(face_landmarks, frame_w, frame_h, stable_points)
 
-    logger.debug("LALAL")
+    fixed_points = landmark_array(generate_edge_points(frame_w, frame_h) + list(stable_points))
+    src_points = np.concatenate([face_landmarks, fixed_points])
+    target_points = np.concatenate([targets, fixed_points])
 
-    # prep delaunay
-    rect = (0, 0, frame_w, frame_h)
-    edge_points = generate_edge_points(frame_w, frame_h)
-    edge_points += stable_points
-    for ep in edge_points:
-        logger.debug("ep: {}".format(ep))
-        point_map[ep] = ep
-    subdiv = cv2.Subdiv2D(rect)
-    for lm in face_landmarks:
-        if is_in_frame(frame_w, frame_h, lm):
-            subdiv.insert(lm)
-    for p in edge_points:
-        subdiv.insert(p)
+    return list(zip(src_points[triangles], target_points[triangles]))
 
-    logger.debug(("delaunay mapping: CHECKPOINT"))
 
-    triangle_mapping = []
-    for triangle in subdiv.getTriangleList():
-        triangle = np.reshape(triangle, (3, 2)).astype(np.int32)
-        target = np.array([point_map[tuple(p)] for p in triangle], dtype=np.int32)
-        triangle_mapping.append((triangle, target))
+class TriangulationCache:
+    """Keeps the triangulations of recently used images, so an image that
+    shows up in several portraits is only triangulated once.
+    An image is identified by its landmarks and frame size, together with
+    the stable points used."""
 
-    return triangle_mapping
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.triangulations = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
+    def get(self, face_landmarks, frame_w, frame_h, stable_points=[]):
+        key = (landmark_array(face_landmarks).tobytes(), frame_w, frame_h, tuple(stable_points))
+        triangles = self.triangulations.get(key)
+        if triangles is not None:
+            self.hits += 1
+            self.triangulations.move_to_end(key)
+            return triangles
+        self.misses += 1
+        triangles = get_delaunay_triangles(face_landmarks, frame_w, frame_h, stable_points)
+        self.triangulations[key] = triangles
+        if self.max_size is not None and len(self.triangulations) > self.max_size:
+            self.triangulations.popitem(last=False)
+        return triangles
+
+
+WARP_AFFINE = "affine"
+WARP_REMAP = "remap"
+WARP_MODES = [WARP_AFFINE, WARP_REMAP]
 
-def align_face(frame, face_landmarks, lm_targets, stable_points):
-    """Takes a frame and face_landmarks and centers the image and warps
-    it.  Returns a frame again, same size as input.
-    """
-    logger.debug("Aligning face ...")
-    f_h, f_w, _ = frame.shape
-    triangle_mapping = get_delaunay_mapping(face_landmarks, lm_targets, f_w, f_h, stable_points)
-    logger.debug(("Triangle mapping generated. "))
 
+def _align_face_affine(frame, triangle_mapping):
+    """Warps the whole frame once per triangle and copies the target
+    triangle over.  Slow, but kept as a reference implementation."""
+    f_h, f_w, _ = frame.shape
     new_frame = np.zeros(frame.shape, dtype=frame.dtype)
 
     for orig, target in triangle_mapping:
@@ -90,65 +138,605 @@ def align_face(frame, face_landmarks, lm_targets, stable_points):
         cv2.fillConvexPoly(new_frame, target, 0)
         cv2.add(new_frame, f, dst=new_frame, mask=mask)
 
+    return new_frame
+
+
+def triangle_index_map(targets, frame_w, frame_h):
+    """Rasterizes the target triangles into a single int32 map holding
+    the index of the triangle covering each pixel, -1 where no triangle
+    covers it.  Later triangles overwrite earlier ones, as in the affine mode."""
+    index_map = np.full((frame_h, frame_w), -1, dtype=np.int32)
+    for i, target in enumerate(targets):
+        cv2.fillConvexPoly(index_map, target, i)
+    return index_map
+
+
+def inverse_affine_matrices(origs, targets):
+    """Takes arrays of shape (n, 3, 2) of source and target triangles and
+    returns the (n, 2, 3) affine matrices mapping target points back to the source.
+    Degenerate target triangles get a matrix that maps everything to (-1, -1)."""
+    n = len(origs)
+    a = np.ones((n, 3, 3), dtype=np.float64)
+    a[:, :, :2] = targets
+    det = np.linalg.det(a)
+    ok = np.abs(det) > 1e-6
+    a[~ok] = np.eye(3)
+    m = np.linalg.solve(a, origs.astype(np.float64))  # (n, 3, 2)
+    m = np.transpose(m, (0, 2, 1))
+    m[~ok] = [[0, 0, -1], [0, 0, -1]]
+    return m
+
+
+def _align_face_remap(frame, triangle_mapping):
+    """Rasterizes the target triangulation once, builds one pair of
+    coordinate maps for all triangles and warps with a single remap."""
+    f_h, f_w, _ = frame.shape
+    if not triangle_mapping:
+        return np.zeros(frame.shape, dtype=frame.dtype)
+    origs = np.array([orig for orig, _ in triangle_mapping], dtype=np.float32)
+    targets = [target for _, target in triangle_mapping]
+    index_map = triangle_index_map(targets, f_w, f_h)
+    m = inverse_affine_matrices(origs, np.array(targets, dtype=np.float32))
+    # an extra last row maps uncovered pixels (index -1) outside the frame
+    m = np.concatenate([m, [[[0, 0, -1], [0, 0, -1]]]]).astype(np.float32)
+    m = m.reshape(-1, 6)
+    xs = np.arange(f_w, dtype=np.float32)[np.newaxis, :]
+    ys = np.arange(f_h, dtype=np.float32)[:, np.newaxis]
+    map_x = m[:, 0][index_map] * xs + m[:, 1][index_map] * ys + m[:, 2][index_map]
+    map_y = m[:, 3][index_map] * xs + m[:, 4][index_map] * ys + m[:, 5][index_map]
+    return cv2.remap(frame, map_x, map_y, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def align_face(frame, face_landmarks, lm_targets, stable_points, warp_mode=WARP_REMAP, triangles=None):
+    """Takes a frame and face_landmarks and centers the image and warps
+    it.  Returns a frame again, same size as input.
+    The warp_mode is one of WARP_MODES, WARP_REMAP is the fast default.
+    triangles is an optional precomputed triangulation, see get_delaunay_triangles.
+    """
+    logger.debug("Aligning face ...")
+    f_h, f_w, _ = frame.shape
+    with timed("triangulation"):
+        triangle_mapping = get_delaunay_mapping(face_landmarks, lm_targets, f_w, f_h, stable_points, triangles)
+    logger.debug(("Triangle mapping generated. "))
+
+    with timed("warp"):
+        if warp_mode == WARP_AFFINE:
+            new_frame = _align_face_affine(frame, triangle_mapping)
+        elif warp_mode == WARP_REMAP:
+            new_frame = _align_face_remap(frame, triangle_mapping)
+        else:
+            raise ValueError("Unknown warp mode: {}".format(warp_mode))
+
     logger.debug("Aligning face done.")
     return new_frame
 
 
-def _align_face(args):
-    """Helper function for parallelization"""
-    logger.info("Aligning face {}".format(args[4]))
-    return align_face(args[0], args[1], args[2], args[3])
+def _align_face_shared(args):
+    """Helper function for parallelization.  Reads the frame from shared
+    memory and writes the aligned frame into the shared output array.
+    Returns the timings of the worker if collect_metrics is set."""
+    frame_spec, out_spec, i, face_landmarks, lm_targets, stable_points, triangles, collect_metrics = args
+    logger.info("Aligning face {}".format(i))
+    metrics = get_metrics()
+    metrics.enabled = collect_metrics
+    frame = SharedArray.attach(frame_spec)
+    out = SharedArray.attach(out_spec)
+    try:
+        out.array[i] = align_face(frame.array, face_landmarks, lm_targets, stable_points,
+                                  triangles=triangles)
+    finally:
+        frame.close()
+        out.close()
+    return metrics.drain() if collect_metrics else None
+
+
+class AlignmentJob:
+    """A set of faces submitted to an AlignmentPool.  The aligned frames
+    are available through wait() until the job is released."""
+
+    def __init__(self, alignment_pool, frame_keys, out, async_result):
+        self.alignment_pool = alignment_pool
+        self.frame_keys = frame_keys
+        self.out = out
+        self.async_result = async_result
+
+    def ready(self):
+        return self.async_result.ready()
+
+    def wait(self):
+        """Blocks until all faces are aligned and returns an array of shape
+        (n, height, width, 3) with the aligned frames."""
+        metrics = get_metrics()
+        for worker_metrics in self.async_result.get():
+            if worker_metrics:
+                metrics.merge(worker_metrics)
+        return self.out.array
+
+    def release(self):
+        """Hands the shared buffers of this job back to the pool."""
+        if self.out is not None:
+            self.async_result.wait()
+            self.alignment_pool._release(self)
+            self.out = None
+
+
+class AlignmentPool:
+    """A long lived pool of worker processes aligning faces.
+    Frames are copied once into shared memory and stay there as long as they
+    are used by a running job or part of consecutive submissions, the workers
+    write the aligned frames into a shared output array.  Nothing but
+    landmarks goes through pickle.
+    Several jobs can be in flight at once, their faces are spread over all workers."""
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.pool = None
+        self.shared_frames = {}  # frame key -> [frame, SharedArray, running job count]
+        self.free_outputs = []
+
+    @staticmethod
+    def _frame_key(rf):
+        """Identifies the image of a recognized frame without loading a lazy frame."""
+        if rf.image_file is not None:
+            return rf.image_file
+        return id(rf.frame)
+
+    def _shared_frame(self, key, rf):
+        entry = self.shared_frames.get(key)
+        if entry is None:
+            frame = rf.frame
+            # keep a reference to frames identified by id, so the id cannot be reused
+            entry = [frame if rf.image_file is None else None, SharedArray.from_array(frame), 0]
+            self.shared_frames[key] = entry
+        entry[2] += 1
+        return entry[1]
+
+    def _output_array(self, shape):
+        for i, out in enumerate(self.free_outputs):
+            if out.shape == shape:
+                return self.free_outputs.pop(i)
+        return SharedArray(shape, np.uint8)
+
+    def _release(self, job):
+        for key in job.frame_keys:
+            self.shared_frames[key][2] -= 1
+        self.free_outputs.append(job.out)
+        # only keep a few spare buffers around
+        while len(self.free_outputs) > self.pool_size:
+            self.free_outputs.pop(0).unlink()
+
+    def _evict_frames(self, keep):
+        """Frees the frames that are neither used by a running job nor in keep."""
+        for key in list(self.shared_frames):
+            if key not in keep and self.shared_frames[key][2] == 0:
+                self.shared_frames.pop(key)[1].unlink()
+
+    def submit(self, recognized_frames, target_landmarks, stable_points, triangulation_cache=None, keep=None):
+        """Submits the frames to be aligned to the target landmarks and returns
+        an AlignmentJob without waiting for it.  The job has to be released.
+        An optional TriangulationCache is used to look up the triangulation of each image.
+        Frames of earlier submissions are freed unless they are in keep, a list
+        of recognized frames that are submitted again soon."""
+        if self.pool is None:
+            # the workers have to share the resource tracker of this process,
+            # otherwise their own trackers unlink the frames when they exit
+            resource_tracker.ensure_running()
+            self.pool = Pool(self.pool_size)
+        keys = [self._frame_key(rf) for rf in recognized_frames]
+        # frames that dropped out of the window are not needed anymore
+        self._evict_frames(set(keys).union(self._frame_key(rf) for rf in keep or []))
+        out = None
+        l = []
+        for i, (key, rf) in enumerate(zip(keys, iter_read_ahead(recognized_frames))):
+            shared_frame = self._shared_frame(key, rf)
+            if out is None:
+                out = self._output_array((len(recognized_frames),) + shared_frame.shape)
+            triangles = None
+            if triangulation_cache is not None:
+                f_h, f_w, _ = shared_frame.shape
+                triangles = triangulation_cache.get(rf.face_landmarks, f_w, f_h, stable_points)
+            l.append((shared_frame.spec, out.spec, i, rf.face_landmarks, target_landmarks,
+                      stable_points, triangles, get_metrics().enabled))
+        async_result = self.pool.map_async(_align_face_shared, l, chunksize=1)
+        return AlignmentJob(self, keys, out, async_result)
+
+    def align(self, recognized_frames, target_landmarks, stable_points, triangulation_cache=None):
+        """Aligns the frames to the target landmarks.  Returns an array of shape
+        (n, height, width, 3) with the aligned frames, it is only valid until
+        the next call."""
+        job = self.submit(recognized_frames, target_landmarks, stable_points, triangulation_cache)
+        aligned = job.wait()
+        job.release()
+        return aligned
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for _, shared_frame, _ in self.shared_frames.values():
+            shared_frame.unlink()
+        self.shared_frames = {}
+        for out in self.free_outputs:
+            out.unlink()
+        self.free_outputs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def get_target_landmarks(recognized_frames):
     a = np.array([rf.face_landmarks for rf in recognized_frames])
-    mean = a.mean(axis=0)
-    mean = mean.astype(np.int32)
-    mean = [tuple(p) for p in mean]
-    return mean
+    return a.mean(axis=0).astype(np.int32)
+
+
+def blend_frames(frames):
+    """Averages the frames.  The frames are summed up in a float32
+    accumulator and only rounded to uint8 once at the end."""
+    with timed("blend"):
+        acc = np.zeros(frames[0].shape, dtype=np.float32)
+        for frame in frames:
+            cv2.accumulate(frame, acc)
+        return cv2.convertScaleAbs(acc, alpha=1 / len(frames))
+
+
+def submit_portrait(recognized_frames, target_landmarks, stable_points, alignment_pool, triangulation_cache=None):
+    """Submits the frames to be aligned to the given target landmarks without
+    waiting.  Returns an AlignmentJob to pass to finish_portrait."""
+    return alignment_pool.submit(recognized_frames, target_landmarks, stable_points, triangulation_cache)
+
+
+def finish_portrait(job):
+    """Waits for the alignment job, blends the aligned frames and releases the job."""
+    try:
+        return blend_frames(job.wait())
+    finally:
+        job.release()
+
 
+def render_portrait(recognized_frames, target_landmarks, stable_points, alignment_pool, triangulation_cache=None):
+    """Aligns the frames to the given target landmarks and blends them together."""
+    return finish_portrait(submit_portrait(recognized_frames, target_landmarks, stable_points,
+                                           alignment_pool, triangulation_cache))
 
-def gen_portrait(recognized_frames, pool_size, stable_points):
+
+def render_preview(recognized_frames, target_landmarks, stable_points, alignment_pool, scale,
+                   triangulation_cache=None):
+    """Renders the portrait from frames downscaled by scale, which is much
+    quicker, and scales the result back up to the size of the frames."""
+    frame_h, frame_w, _ = recognized_frames[0].frame.shape
+    small_frames = [rf.scaled(scale) for rf in recognized_frames]
+    # the full size frames stay in the pool for the full render
+    preview = finish_portrait(alignment_pool.submit(small_frames,
+                                                    scale_face_landmarks(target_landmarks, scale),
+                                                    [scale_point(p, scale) for p in stable_points],
+                                                    triangulation_cache, keep=recognized_frames))
+    return cv2.resize(preview, (frame_w, frame_h), interpolation=cv2.INTER_LINEAR)
+
+
+def gen_portrait(recognized_frames, pool_size, stable_points, triangulation_cache=None, alignment_pool=None):
     """Generates a merged portrait with the given images.
-    pool_size is the amount of threads to use while processing."""
+    pool_size is the amount of threads to use while processing.
+    An optional TriangulationCache is used to look up the triangulation of each image.
+    If an AlignmentPool is given it is used instead of a temporary pool of pool_size."""
     logger.info("gen portrait: given frames count: {}".format(len(recognized_frames)))
-    logger.debug("recognized_frames: {}".format(recognized_frames))
+    logger.debug("recognized_frames: %s", recognized_frames)
     assert len(recognized_frames) > 0
+    if alignment_pool is None:
+        with AlignmentPool(pool_size) as p:
+            return gen_portrait(recognized_frames, pool_size, stable_points, triangulation_cache, p)
     target_landmarks = get_target_landmarks(recognized_frames)
-    logger.debug("target_landmarks: {}".format(target_landmarks))
-    # align the images to the target landmarks
-    with Pool(pool_size) as p:
-        l = []
-        for i, rf in enumerate(recognized_frames):
-            l.append((rf.frame, rf.face_landmarks, target_landmarks, stable_points, i))
-        logger.debug("l: {}".format(l))
-        collected_frames = p.map(_align_face, l)
-    # overlay the aligned images
-    f = np.zeros(shape=collected_frames[0].shape,
-                 dtype=np.uint8)
-    for pframe in collected_frames:
-        cv2.addWeighted(f, 1, pframe, (1 / len(collected_frames)), 0, f)
-    return f
+    logger.debug("target_landmarks: %s", target_landmarks)
+    return render_portrait(recognized_frames, target_landmarks, stable_points, alignment_pool, triangulation_cache)
+
+
+def _accumulate_faces(args):
+    """Helper function for parallelization.  Reads, aligns and sums up the
+    images into one slot of the shared accumulator, so every task keeps its
+    own sum and only one image per worker is in memory at a time.
+    Returns the number of images added and the images skipped."""
+    acc_spec, slot, image_files, face_landmarkss, lm_targets, stable_points, collect_metrics = args
+    metrics = get_metrics()
+    metrics.enabled = collect_metrics
+    acc = SharedArray.attach(acc_spec)
+    slot_acc = acc.array[slot]
+    added = 0
+    skipped = []
+    try:
+        for image_file, face_landmarks in zip(image_files, face_landmarkss):
+            frame = cv2.imread(image_file)
+            if frame is None or frame.shape != slot_acc.shape:
+                skipped.append(image_file)
+                continue
+            cv2.accumulate(align_face(frame, face_landmarks, lm_targets, stable_points), slot_acc)
+            added += 1
+    finally:
+        # the shared memory can only be closed once no view is left
+        slot_acc = None
+        acc.close()
+    return added, skipped, metrics.drain() if collect_metrics else None
+
+
+def _add_accumulators(args):
+    """Helper function for parallelization.  Adds slot src of the shared
+    accumulator to slot dst and clears src."""
+    acc_spec, dst, src = args
+    acc = SharedArray.attach(acc_spec)
+    try:
+        np.add(acc.array[dst], acc.array[src], out=acc.array[dst])
+        acc.array[src] = 0
+    finally:
+        acc.close()
+
+
+class PortraitAccumulator:
+    """Sums up aligned faces read straight from their image files, for
+    portraits of more images than fit into memory.  Every worker adds its
+    share of the images to its own float32 sum in shared memory, the sums
+    are added up in a tree at the end.  Memory use only depends on the
+    pool size and the frame size, not on the number of images.
+    Sums of uint8 images are exact in float32 up to 65793 images, so the
+    portrait is the same as gen_portrait's."""
+
+    def __init__(self, pool_size, frame_shape):
+        self.pool_size = pool_size
+        self.frame_shape = tuple(frame_shape)
+        self.pool = None
+        self.acc = SharedArray((pool_size,) + self.frame_shape, np.float32)
+        self.acc.array[...] = 0
+        self.count = 0
+
+    def add(self, image_files, face_landmarkss, target_landmarks, stable_points):
+        """Aligns the images to the target landmarks and adds them to the sum.
+        Returns the image files that were skipped because they could not be
+        read or have a different size."""
+        if self.pool is None:
+            # see AlignmentPool.submit
+            resource_tracker.ensure_running()
+            self.pool = Pool(self.pool_size)
+        collect_metrics = get_metrics().enabled
+        tasks = [(self.acc.spec, slot, image_files[slot::self.pool_size], face_landmarkss[slot::self.pool_size],
+                  target_landmarks, stable_points, collect_metrics)
+                 for slot in range(self.pool_size)]
+        skipped = []
+        for added, slot_skipped, worker_metrics in self.pool.map(_accumulate_faces, tasks, chunksize=1):
+            self.count += added
+            skipped.extend(slot_skipped)
+            if worker_metrics:
+                get_metrics().merge(worker_metrics)
+        return skipped
+
+    def reduce(self):
+        """Adds up the sums of all slots in a tree, returns the total sum.
+        The returned array is only valid until the next call."""
+        step = 1
+        while step < self.pool_size:
+            pairs = [(self.acc.spec, dst, dst + step) for dst in range(0, self.pool_size - step, 2 * step)]
+            if self.pool is None:
+                for pair in pairs:
+                    _add_accumulators(pair)
+            else:
+                self.pool.map(_add_accumulators, pairs, chunksize=1)
+            step *= 2
+        return self.acc.array[0]
+
+    def load(self, total, count):
+        """Continues from a sum of count images, as returned by reduce."""
+        self.acc.array[...] = 0
+        self.acc.array[0] = total
+        self.count = count
+
+    def portrait(self):
+        """The average of all images added so far."""
+        assert self.count > 0
+        with timed("blend"):
+            return cv2.convertScaleAbs(self.reduce(), alpha=1 / self.count)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.acc is not None:
+            self.acc.unlink()
+            self.acc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PortraitWindow:
+    """The last stack_size recognized frames.  Keeps a running sum of the
+    landmarks, so the target landmarks are updated in constant time when
+    a frame enters or leaves the window."""
+
+    def __init__(self, stack_size):
+        self.stack_size = stack_size
+        self.recognized_frames = deque()
+        self.landmark_sum = None
+
+    def __len__(self):
+        return len(self.recognized_frames)
+
+    def is_full(self):
+        return len(self.recognized_frames) >= self.stack_size
+
+    def check(self, recognized_frames):
+        """Raises a ValueError unless the frames and their landmarks have the
+        same shapes as each other and as the frames in the window."""
+        if not recognized_frames:
+            return
+        reference = self.recognized_frames[0] if self.recognized_frames else recognized_frames[0]
+        for rf in recognized_frames:
+            if rf.face_landmarks.shape != reference.face_landmarks.shape:
+                raise ValueError("Expected landmarks of shape {}, got {}.".format(
+                    reference.face_landmarks.shape, rf.face_landmarks.shape))
+            if rf.frame.shape != reference.frame.shape:
+                raise ValueError("Expected frames of shape {}, got {}.".format(
+                    reference.frame.shape, rf.frame.shape))
+
+    def push(self, recognized_frame):
+        """Adds a frame to the window, dropping the oldest frame if the window is full."""
+        landmarks = recognized_frame.face_landmarks.astype(np.int64)
+        if self.landmark_sum is None:
+            self.landmark_sum = np.zeros(landmarks.shape, dtype=np.int64)
+        # fails for landmarks of another shape before the window is changed
+        self.landmark_sum += landmarks
+        self.recognized_frames.append(recognized_frame)
+        if len(self.recognized_frames) > self.stack_size:
+            dropped = self.recognized_frames.popleft()
+            self.landmark_sum -= dropped.face_landmarks
+
+    def target_landmarks(self):
+        """The mean landmarks of the frames in the window, same as get_target_landmarks."""
+        return (self.landmark_sum / len(self.recognized_frames)).astype(np.int32)
+
+    def submit(self, stable_points, alignment_pool, triangulation_cache=None):
+        """Submits the current window for rendering, see submit_portrait."""
+        assert len(self.recognized_frames) > 0
+        return submit_portrait(list(self.recognized_frames), self.target_landmarks(), stable_points,
+                               alignment_pool, triangulation_cache)
+
+    def render(self, stable_points, alignment_pool, triangulation_cache=None):
+        logger.info("render portrait: frames in window: {}".format(len(self.recognized_frames)))
+        return finish_portrait(self.submit(stable_points, alignment_pool, triangulation_cache))
 
 
 class PortraitGen:
+    """Keeps the last stack_size faces and their merged portrait.
+    New faces enter the window at once, but at most one render runs at a
+    time: updates arriving during a render are coalesced into a single
+    follow-up render of the whole window, which they wait for.  on_render is called with every
+    new portrait.  Reading the portrait never waits for a render.
+    With a preview_scale, every render first publishes a quick portrait
+    rendered at that scale, which the full resolution one then replaces.
+    Instead of a local AlignmentPool of pool_size, another alignment pool
+    with the same interface can be given, it is closed with the PortraitGen."""
 
-    def __init__(self, stack_size, pool_size, stable_points):
+    def __init__(self, stack_size, pool_size, stable_points, on_render=None, preview_scale=None,
+                 alignment_pool=None):
         self.stack_size = stack_size
         self.pool_size = pool_size
         self.stable_points = stable_points
-        self.recognized_frames = []
+        self.on_render = on_render
+        self.preview_scale = preview_scale
+        self.window = PortraitWindow(stack_size)
         self.target_landmarks = None
         self.portrait_frame = None
+        self.triangulation_cache = TriangulationCache(stack_size)
+        self.preview_triangulation_cache = TriangulationCache(stack_size)
+        self.alignment_pool = alignment_pool if alignment_pool is not None else AlignmentPool(pool_size)
+        # guards the window and the counters
+        self.lock = threading.Lock()
+        # held by the thread that is rendering
+        self.render_lock = threading.Lock()
+        # counts the updates, rendered is the count included in the last finished render
+        self.generation = 0
+        self.rendered_generation = 0
+        self.render_finished = threading.Condition(self.lock)
+        self.pending_updates = 0
+        self.updates = 0
+        self.renders = 0
+        self.coalesced = 0
 
-    def update(self, recognized_frames):
-        """Updates the generated image, the merge of all the faces."""
+    @property
+    def recognized_frames(self):
+        with self.lock:
+            return list(self.window.recognized_frames)
+
+    def update(self, recognized_frames, on_added=None):
+        """Adds the faces to the window and updates the generated image, the
+        merge of all the faces.  If another thread is rendering, the update
+        is left to that thread's follow-up render, which this waits for, so
+        get_portrait includes the faces once this returns.
+        Returns whether the faces were added.  Raises a ValueError without
+        adding any if they do not match the faces in the window, see
+        PortraitWindow.check.  on_added is called with the faces once they
+        are in the window, before the render."""
         if not recognized_frames:
             return False
-        self.recognized_frames += recognized_frames
-        self.recognized_frames = self.recognized_frames[- self.stack_size:]
-        self.portrait_frame = gen_portrait(self.recognized_frames, self.pool_size, self.stable_points)
+        with self.lock:
+            # checked and added in one go, so concurrent updates cannot both pass the check
+            self.window.check(recognized_frames)
+            for rf in recognized_frames:
+                self.window.push(rf)
+            self.updates += 1
+            self.pending_updates += 1
+            self.generation += 1
+            generation = self.generation
+        if on_added is not None:
+            on_added(recognized_frames)
+        self._render_pending()
+        with self.render_finished:
+            self.render_finished.wait_for(lambda: self.rendered_generation >= generation)
         return True
 
+    def _render_pending(self):
+        """Renders until no updates are pending, unless another thread is rendering."""
+        while self.render_lock.acquire(blocking=False):
+            try:
+                while True:
+                    with self.lock:
+                        if not self.pending_updates:
+                            break
+                        self.coalesced += self.pending_updates - 1
+                        self.pending_updates = 0
+                        generation = self.generation
+                        recognized_frames = list(self.window.recognized_frames)
+                        target_landmarks = self.window.target_landmarks()
+                    try:
+                        self._render(recognized_frames, target_landmarks)
+                    finally:
+                        # also on errors, the waiting updates must not hang
+                        with self.render_finished:
+                            self.rendered_generation = generation
+                            self.render_finished.notify_all()
+            finally:
+                self.render_lock.release()
+            # an update may have arrived after the last check, but before the release
+            with self.lock:
+                if not self.pending_updates:
+                    return
+
+    def _render(self, recognized_frames, target_landmarks):
+        logger.info("render portrait: frames in window: {}".format(len(recognized_frames)))
+        if self.preview_scale is not None:
+            with timed("render_preview"):
+                preview = render_preview(recognized_frames, target_landmarks, self.stable_points,
+                                         self.alignment_pool, self.preview_scale,
+                                         self.preview_triangulation_cache)
+            self._publish(target_landmarks, preview)
+        with timed("render"):
+            portrait_frame = render_portrait(recognized_frames, target_landmarks, self.stable_points,
+                                             self.alignment_pool, self.triangulation_cache)
+        with self.lock:
+            self.renders += 1
+        self._publish(target_landmarks, portrait_frame)
+
+    def _publish(self, target_landmarks, portrait_frame):
+        with self.lock:
+            self.target_landmarks = target_landmarks
+            # replaced in one assignment, so readers see the old or the new portrait
+            self.portrait_frame = portrait_frame
+        if self.on_render is not None:
+            self.on_render(portrait_frame)
+
+    def stats(self):
+        """How many updates arrived, how many renders ran and how many
+        updates were coalesced into the render of a later one."""
+        with self.lock:
+            return {"updates": self.updates, "renders": self.renders, "coalesced": self.coalesced}
+
     def get_portrait(self):
         return self.portrait_frame
+
+    def close(self):
+        with self.render_lock:
+            self.alignment_pool.close()
@@ -0,0 +1,46 @@
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedArray:
+    """A numpy array backed by a shared memory block.  The creating process
+    owns the block and has to unlink it, other processes attach to it with
+    the spec of the array and only close it."""
+
+    def __init__(self, shape, dtype=np.uint8, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = SharedMemory(create=True, size=size)
+        else:
+            self.shm = SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, a):
+        """Creates a new shared array holding a copy of a."""
+        sa = cls(a.shape, a.dtype)
+        sa.array[...] = a
+        return sa
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    @property
+    def spec(self):
+        """A small picklable description to attach to the array from another process."""
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        # the buffer can only be released once no view is left
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
@@ -1,26 +1,144 @@
-import pyaudio
+import logging
+import threading
+import time
 import wave
+import numpy as np
 
+try:
+    import pyaudio
+except ImportError:  # headless boxes without audio
+    pyaudio = None
 
-class SoundPlayer:
 
-    # https://stackoverflow.com/questions/17657103/how-to-play-wav-file-in-python
+logger = logging.getLogger(__name__)
+
+# sample width in bytes -> sample dtype
+SAMPLE_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+class NullStream:
+    """Stands in for an audio output stream if there is no audio device.
+    Calls the callback at the pace of real playback and discards the audio."""
+
+    def __init__(self, callback, rate, frames_per_buffer):
+        self.callback = callback
+        self.interval = frames_per_buffer / rate
+        self.frames_per_buffer = frames_per_buffer
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="NullAudioStream", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            self.callback(None, self.frames_per_buffer, None, 0)
+            time.sleep(self.interval)
+
+    def get_output_latency(self):
+        return 0.0
+
+    def stop_stream(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+        self.thread.join()
 
-    def __init__(self, filename):
+
+class SoundPlayer:
+    """Plays a short sound cue with low latency.  The sound is decoded into
+    memory once and played through a single output stream that stays open.
+    play() only schedules the cue and returns immediately, cues triggered
+    while another one is still playing are mixed on top of it.
+    Without an audio device the cue is played to a null stream."""
+
+    def __init__(self, filename, frames_per_buffer=256):
         self.filename = filename
+        self.frames_per_buffer = frames_per_buffer
+        with wave.open(self.filename, "rb") as f:
+            self.sample_width = f.getsampwidth()
+            self.channels = f.getnchannels()
+            self.rate = f.getframerate()
+            data = f.readframes(f.getnframes())
+        if self.sample_width not in SAMPLE_DTYPES:
+            raise ValueError("Unsupported sample width: {}".format(self.sample_width))
+        self.dtype = SAMPLE_DTYPES[self.sample_width]
+        self.samples = np.frombuffer(data, dtype=self.dtype).reshape(-1, self.channels)
+        self.lock = threading.Lock()
+        self.voices = []  # [position, trigger time]
+        self.latencies = []  # seconds from play() to the cue reaching the output
+        self.pyaudio = None
+        self.stream = None
+
+    def open(self):
+        """Opens the output stream, play() does it if it was not done before."""
+        with self.lock:
+            if self.stream is None:
+                self._open()
+
+    def _open(self):
+        if pyaudio is not None:
+            try:
+                self.pyaudio = pyaudio.PyAudio()
+                self.stream = self.pyaudio.open(format=self.pyaudio.get_format_from_width(self.sample_width),
+                                                channels=self.channels,
+                                                rate=self.rate,
+                                                output=True,
+                                                frames_per_buffer=self.frames_per_buffer,
+                                                stream_callback=self._callback)
+                return
+            except (OSError, IOError):
+                logger.warning("No audio output device, playing sounds to a null device.")
+                if self.pyaudio is not None:
+                    self.pyaudio.terminate()
+                    self.pyaudio = None
+        self.stream = NullStream(self._callback, self.rate, self.frames_per_buffer)
+
+    def _mix(self, frame_count):
+        """Mixes the active voices into frame_count frames of audio."""
+        offset = 128 if self.dtype == np.uint8 else 0
+        info = np.iinfo(self.dtype)
+        out = np.zeros((frame_count, self.channels), dtype=np.int64)
+        now = time.perf_counter()
+        output_latency = self.stream.get_output_latency() if self.stream is not None else 0.0
+        remaining = []
+        for voice in self.voices:
+            position, trigger_time = voice
+            if position == 0:
+                self.latencies.append(now - trigger_time + output_latency)
+                self.latencies = self.latencies[-100:]
+            chunk = self.samples[position:position + frame_count]
+            out[:len(chunk)] += chunk.astype(np.int64) - offset
+            voice[0] = position + frame_count
+            if voice[0] < len(self.samples):
+                remaining.append(voice)
+        self.voices = remaining
+        return np.clip(out + offset, info.min, info.max).astype(self.dtype)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        with self.lock:
+            data = self._mix(frame_count).tobytes()
+        return data, pyaudio.paContinue if pyaudio is not None else 0
 
     def play(self):
-        chunk = 1024
-        f = wave.open(self.filename, "rb")
-        p = pyaudio.PyAudio()
-        stream = p.open(format=p.get_format_from_width(f.getsampwidth()),
-                        channels=f.getnchannels(),
-                        rate=f.getframerate(),
-                        output=True)
-        data = f.readframes(chunk)
-        while data:
-            stream.write(data)
-            data = f.readframes(chunk)
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
+        """Starts playing the cue and returns without waiting for it."""
+        with self.lock:
+            if self.stream is None:
+                self._open()
+            self.voices.append([0, time.perf_counter()])
+
+    def latency_stats(self):
+        """The mean and maximum trigger to output latency in seconds of the last cues."""
+        with self.lock:
+            if not self.latencies:
+                return None
+            return {"mean": float(np.mean(self.latencies)), "max": float(np.max(self.latencies))}
+
+    def close(self):
+        with self.lock:
+            stream, self.stream = self.stream, None
+        if stream is not None:
+            stream.stop_stream()
+            stream.close()
+        if self.pyaudio is not None:
+            self.pyaudio.terminate()
+            self.pyaudio = None
@@ -1,4 +1,12 @@
 import cv2
+import numpy as np
+from artsci2019.lib.frame_cache import get_frame_cache
+
+
+def landmark_array(face_landmarks):
+    """Returns the landmarks as an int32 array of shape (n, 2), without a
+    copy if they already are one.  Takes any sequence of (x, y) pairs."""
+    return np.asarray(face_landmarks, dtype=np.int32).reshape(-1, 2)
 
 
 def scale_point(point, factor):
@@ -7,17 +15,17 @@ def scale_point(point, factor):
             int(y * factor))
 
 
+def scale_face_landmarks(face_landmarks, factor):
+    # truncated towards zero like scale_point
+    return (landmark_array(face_landmarks) * factor).astype(np.int32)
+
+
 def scale_face_landmarkss(face_landmarkss, factor):
-    return [[(int(x * factor),
-              int(y * factor))
-             for x, y in flms]
-            for flms in face_landmarkss]
+    return [scale_face_landmarks(flms, factor) for flms in face_landmarkss]
 
 
 def crop_face_landmarks(face_landmarks, x_offset, y_offset):
-    return [(x - x_offset,
-             y - y_offset)
-            for x, y in face_landmarks]
+    return landmark_array(face_landmarks) - np.array([x_offset, y_offset], dtype=np.int32)
 
 
 def scale_frame(frame, factor):
@@ -33,12 +41,48 @@ def is_in_frame(frame_w, frame_h, lm):
     return lm[0] < frame_w and lm[1] < frame_h and lm[0] >= 0 and lm[1] >= 0
 
 
+def in_frame_mask(frame_w, frame_h, points):
+    """is_in_frame for an array of points, returns a boolean array."""
+    return (points[:, 0] < frame_w) & (points[:, 1] < frame_h) & (points[:, 0] >= 0) & (points[:, 1] >= 0)
+
+
 class RecognizedFrame:
-    def __init__(self, frame, face_landmarks):
-        self.frame = frame
-        self.face_landmarks = face_landmarks
-        self.left_eye = self.face_landmarks[36]
-        self.right_eye = self.face_landmarks[45]
+    """A face found in a frame.  The landmarks are an int32 array of shape
+    (n, 2), in the order of face_recog._face_landmarks_to_array."""
+
+    __slots__ = ("_frame", "image_file", "face_landmarks")
+
+    def __init__(self, frame, face_landmarks, image_file=None):
+        """If no frame but an image_file is given, the frame is loaded
+        lazily through the frame cache on first access."""
+        self._frame = frame
+        self.image_file = image_file
+        self.face_landmarks = landmark_array(face_landmarks)
+
+    @property
+    def left_eye(self):
+        x, y = self.face_landmarks[36]
+        return int(x), int(y)
+
+    @property
+    def right_eye(self):
+        x, y = self.face_landmarks[45]
+        return int(x), int(y)
+
+    @property
+    def frame(self):
+        if self._frame is None and self.image_file is not None:
+            return get_frame_cache().get(self.image_file)
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        self._frame = frame
+
+    def prefetch(self):
+        """Starts loading a lazy frame in the background."""
+        if self._frame is None and self.image_file is not None:
+            get_frame_cache().prefetch([self.image_file])
 
     def cropped(self, new_width, new_height, x_offset, y_offset):
         return RecognizedFrame(
@@ -46,8 +90,45 @@ class RecognizedFrame:
             crop_face_landmarks(self.face_landmarks, x_offset, y_offset)
         )
 
+    def scaled(self, factor):
+        return RecognizedFrame(
+            scale_frame(self.frame, factor),
+            scale_face_landmarks(self.face_landmarks, factor)
+        )
+
+    def __getstate__(self):
+        # pickled with the frame itself and the same keys as before lazy frames
+        # and landmark arrays existed
+        return {
+            "frame": self.frame,
+            "face_landmarks": self.face_landmarks,
+            "left_eye": self.left_eye,
+            "right_eye": self.right_eye,
+        }
+
+    def __setstate__(self, state):
+        # also reads pickles with list landmarks or a lazy frame's attributes
+        frame = state.get("frame")
+        self._frame = frame if frame is not None else state.get("_frame")
+        self.image_file = state.get("image_file")
+        self.face_landmarks = landmark_array(state["face_landmarks"])
+
     def __repr__(self):
-        return str([self.frame,
-                    self.face_landmarks,
+        return str([self._frame if self._frame is not None else self.image_file,
+                    self.face_landmarks.tolist(),
                     self.left_eye,
                     self.right_eye])
+
+
+def iter_read_ahead(recognized_frames, read_ahead=None):
+    """Yields the recognized frames, starting to load the next read_ahead
+    lazy frames in the background."""
+    if read_ahead is None:
+        read_ahead = get_frame_cache().read_ahead
+    recognized_frames = list(recognized_frames)
+    for rf in recognized_frames[:read_ahead]:
+        rf.prefetch()
+    for i, rf in enumerate(recognized_frames):
+        if i + read_ahead < len(recognized_frames):
+            recognized_frames[i + read_ahead].prefetch()
+        yield rf